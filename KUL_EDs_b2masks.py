@@ -11,34 +11,726 @@
 # This python script was developed in python3.8
 # v: 0.6 - 09122021
 # This workflow does the following:
-# 1- Recieve input (described in def main lines 23-47) from user 
+# 1- Recieve input (described in def main) from user, or from a call to edsB2masks when imported
 # 2- Find the external edge of the 2 input masks
 # 3- Find centers of gravity from numpy arrays of both input masks 
-# 4- Calculate Euclidean distances between every voxel of A to every voxel of B
+# 4- Calculate Euclidean distances between every voxel of A to the nearest voxel of B (KD-tree, distance transform, or brute force as reference)
 # 5- Calculate distances between every voxel of A to cogB and vice versa
 # 6- Calculate distances between both masks' COGs
-# 7- Find index of voxels giving min distances
-# 8- Print to CLI and save to output text files and nifti files
+# 7- Find index of voxels giving min distances (all tied voxel pairs are reported)
+# 8- Print to CLI and save to output text files (optionally json/csv) and nifti files
+# 8b- Surface distance metrics between the outlines: directed and symmetric Hausdorff, HD95 and ASSD
 # 9- This is supplemented by overlap COG, respective distance calculations and overlap count and volume ratios if masks are initially overlapping
 
-## To do:
-# 1- What if more than one voxel have shortest distance?
-
-import os, sys, getopt
+import os, sys, getopt, glob, csv, json, gzip
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 import nibabel as nib
 import numpy as np
 from scipy import ndimage
+from scipy.spatial import cKDTree, distance
+
+# distance engines to choose from with -m
+# kdtree = nearest neighbour search on a KD-tree of mask B (default)
+# edt = one Euclidean distance transform of mask B, also saved as a distance-to-B map
+# blocked = every voxel of A to every voxel of B in tiles under a memory ceiling (-M, in MB)
+# brute = every voxel of A to every voxel of B, kept as a reference
+modes = ['kdtree', 'edt', 'blocked', 'brute']
+
+# brute force reference engine
+# builds the full (voxels A, voxels B) distance matrix
+# returns the minimum distance and the indices of all A and B voxels giving it
+def minDistBrute(xyz1, xyz2):
+    results = np.zeros((xyz1.shape[0], xyz2.shape[0]), np.float32)
+    # loop over in1 nonzero voxel mm coordinates
+    # calculate distances between every voxel in in1 to in2
+    for ii in range(0,xyz1.shape[0]):
+        for jj in range(0,xyz2.shape[0]):
+            results[ii,jj] = np.linalg.norm(xyz1[ii]-xyz2[jj])
+    all_min = (np.amin(results))
+    alidx = np.where(results == all_min)
+    return all_min, alidx
+
+# KD-tree engine, O(N log M) instead of O(N x M)
+# queries the nearest voxel of B for every voxel of A
+# then collects all B voxels tied at the minimum for the A voxels giving it
+# distances are rounded to float32 as in the brute force matrix so both engines report the same numbers
+# the tree of B and the (unrounded) nearest neighbour distances are returned for the surface distances
+def minDistKdtree(xyz1, xyz2):
+    tree = cKDTree(xyz2)
+    nn_ds = tree.query(xyz1, k=1)[0]
+    nn_ds32 = np.float32(nn_ds)
+    all_min = np.amin(nn_ds32)
+    alidx = tiedPairs(tree, xyz1, xyz2, np.where(nn_ds32 == all_min)[0], all_min)
+    return all_min, alidx, tree, nn_ds
+
+# all B voxels tied at all_min for the given rows of A, on a KD-tree of B
+# only the B voxels within all_min of each row are looked at
+def tiedPairs(tree, xyz1, xyz2, rows, all_min):
+    a_idx = []
+    b_idx = []
+    for ii in rows:
+        # look a bit further than all_min to catch voxels lost to rounding
+        cands = np.array(tree.query_ball_point(xyz1[ii], np.float64(all_min) * (1 + 1e-6) + 1e-6), dtype=np.intp)
+        cands = np.sort(cands)
+        ds = np.float32(np.linalg.norm(xyz2[cands] - xyz1[ii], axis=1))
+        for jj in cands[ds == all_min]:
+            a_idx.append(ii)
+            b_idx.append(jj)
+    return (np.array(a_idx, dtype=np.intp), np.array(b_idx, dtype=np.intp))
+
+# distance transform engine, linear in the volume size
+# runs one EDT of the outline of mask B, sampled with the voxel sizes of the affine
+# and reads the minimum over the outline voxels of mask A
+# outside mask B the distance to its outline equals the distance to mask B
+# so the same field is returned as a per voxel distance-to-B map (0 inside B)
+# the voxel pairs at the minimum are recomputed from the mm coordinates of the candidates on a KD-tree of B
+def minDistEdt(outline2, im2_data, aff, ijk1, xyz1, xyz2):
+    vox_size = nib.affines.voxel_sizes(aff)
+    dt = ndimage.distance_transform_edt(outline2 == 0, sampling=vox_size)
+    dt_a = np.float32(dt[tuple(ijk1.T)])
+    # candidates within rounding of the EDT minimum
+    cands = np.where(dt_a <= np.amin(dt_a) * (1 + 1e-5) + 1e-5)[0]
+    # exact nearest B voxels of the candidates only, no (candidates, voxels B) matrix
+    tree = cKDTree(xyz2)
+    cand_ds = np.float32(tree.query(xyz1[cands], k=1)[0])
+    all_min = np.amin(cand_ds)
+    alidx = tiedPairs(tree, xyz1, xyz2, cands[cand_ds == all_min], all_min)
+    dist_map = np.float32(dt)
+    dist_map[im2_data != 0] = 0
+    return all_min, alidx, dist_map, tree
+
+# blocked pairwise engine with bounded memory
+# streams over tiles of A x B and only keeps the running minimum and its tied voxel pairs
+# the distances of a tile are written by cdist into one preallocated float64 tile and rounded into a float32 tile
+# so a tile of n pairs needs about 16 bytes per pair (8 + 4, and the comparison with the minimum)
+def minDistBlocked(xyz1, xyz2, max_mem=512):
+    if xyz1.shape[0] == 0 or xyz2.shape[0] == 0:
+        raise ValueError('mask A or mask B has no voxels')
+    pairs = max(1, int(max_mem * 1024 * 1024 / 16))
+    nb = max(1, min(xyz2.shape[0], pairs))
+    na = max(1, min(xyz1.shape[0], pairs // nb))
+    buf64 = np.empty(na * nb, np.float64)
+    buf32 = np.empty(na * nb, np.float32)
+    all_min = np.float32(np.inf)
+    a_idx = []
+    b_idx = []
+    for a0 in range(0, xyz1.shape[0], na):
+        for b0 in range(0, xyz2.shape[0], nb):
+            part1 = xyz1[a0:a0+na]
+            part2 = xyz2[b0:b0+nb]
+            # contiguous views for the edge tiles
+            d64 = buf64[:part1.shape[0] * part2.shape[0]].reshape(part1.shape[0], part2.shape[0])
+            tile = buf32[:d64.size].reshape(d64.shape)
+            distance.cdist(part1, part2, out=d64)
+            tile[...] = d64
+            tile_min = np.amin(tile)
+            if tile_min < all_min:
+                all_min = tile_min
+                a_idx = []
+                b_idx = []
+            if tile_min == all_min:
+                ties = np.where(tile == all_min)
+                a_idx.append(ties[0] + a0)
+                b_idx.append(ties[1] + b0)
+    # order the pairs like the full matrix would
+    a_idx = np.concatenate(a_idx)
+    b_idx = np.concatenate(b_idx)
+    order = np.lexsort((b_idx, a_idx))
+    alidx = (a_idx[order], b_idx[order])
+    return all_min, alidx
+
+# surface distance metrics between the outlines of two masks
+# nearest neighbour distances from every outline voxel of A to the outline of B and vice versa, on KD-trees
+# Hausdorff = largest of these, HD95 = 95th percentile of both directions pooled,
+# ASSD = mean of the two directed average surface distances (as in MedPy)
+# nn holds what the distance engine already has: the KD-tree of B ('tree') and the distances of A to it ('d_ab')
+# only the missing trees and queries are done here
+def surfaceDistances(xyz1, xyz2, nn=None):
+    nn = nn or {}
+    d_ab = nn.get('d_ab')
+    if d_ab is None:
+        tree2 = nn.get('tree')
+        if tree2 is None:
+            tree2 = cKDTree(xyz2)
+        d_ab = tree2.query(xyz1, k=1)[0]
+    d_ba = cKDTree(xyz1).query(xyz2, k=1)[0]
+    sd = {}
+    sd['hd_AB'] = np.amax(d_ab)
+    sd['hd_BA'] = np.amax(d_ba)
+    sd['hd'] = max(sd['hd_AB'], sd['hd_BA'])
+    sd['hd95'] = np.percentile(np.hstack((d_ab, d_ba)), 95)
+    sd['asd_AB'] = np.mean(d_ab)
+    sd['asd_BA'] = np.mean(d_ba)
+    sd['assd'] = np.mean((sd['asd_AB'], sd['asd_BA']))
+    return sd
+
+# the EDT samples the grid along the voxel axes
+# this is only exact if the affine has no shear (orthogonal voxel axes)
+def isOrthogonal(aff):
+    rzs = aff[:3, :3]
+    gram = rzs.T @ rzs
+    return np.allclose(gram - np.diag(np.diag(gram)), 0, atol=1e-4)
+
+# read a mask as a compact boolean array
+# through the data proxy, slab by slab along the third axis, instead of a float64 get_fdata copy
+# uncompressed .nii inputs are memory mapped so only the slab being converted is in memory
+# .nii.gz inputs must be loaded with keep_file_open=True, the slabs are then read in one forward pass
+# over the open gzip stream instead of decompressing from the start for every slab
+# voxels >= 1 are in the mask, as with the previous uint16 truncation of get_fdata
+def loadMask(img, slab=16):
+    shape = img.shape[:3]
+    data = np.empty(shape, bool)
+    for k in range(0, shape[2], slab):
+        np.greater_equal(np.asanyarray(img.dataobj[:, :, k:k + slab]), 1, out=data[:, :, k:k + slab])
+    return data
+
+# load a mask and precompute everything that only depends on that mask
+# masks are kept as booleans, then a 1x erosion, the difference is the edge
+# COG and outline coordinates are kept in voxels and mm of the full image
+# if a margin is given the arrays are cropped to the bounding box of the mask plus that margin
+# and 'offset' holds the voxel position of the subvolume in the full image
+def prepareMask(in_file, margin=None):
+    img = nib.load(in_file, mmap=True, keep_file_open=True)
+    m = {}
+    m['file'] = in_file
+    m['aff'] = img.affine
+    m['full_shape'] = img.shape[:3]
+    data = loadMask(img)
+    m['offset'] = np.zeros(3, np.intp)
+    if margin is not None and np.any(data):
+        nz = np.nonzero(data)
+        lo = [max(0, int(np.amin(ax)) - margin) for ax in nz]
+        hi = [min(sh, int(np.amax(ax)) + margin + 1) for ax, sh in zip(nz, data.shape)]
+        data = data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]].copy()
+        m['offset'] = np.array(lo, np.intp)
+    m['data'] = data
+    m['eroded'] = ndimage.morphology.binary_erosion(m['data'])
+    m['outline'] = m['data'] & ~m['eroded']
+    # (voxels, 3) array of the nonzero voxels
+    m['ijk'] = np.argwhere(m['outline']) + m['offset']
+    # convert the voxel coordinates to mm coordinates
+    m['xyz'] = nib.affines.apply_affine(m['aff'], m['ijk'])
+    # to get cogs in voxel coords, then convert voxel coords to mm
+    m['cog'] = tuple(c + o for c, o in zip(ndimage.measurements.center_of_mass(m['data']), m['offset']))
+    m['cog_xyz'] = nib.affines.apply_affine(m['aff'], m['cog'])
+    return m
+
+# the overlap of two prepared masks, on the intersection of their subvolumes
+# returned as a mask like dict with 'data' and 'offset'
+def overlapMask(A, B):
+    lo = np.maximum(A['offset'], B['offset'])
+    hi = np.minimum(A['offset'] + A['data'].shape, B['offset'] + B['data'].shape)
+    hi = np.maximum(hi, lo)
+    a_sl = tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, A['offset']))
+    b_sl = tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, B['offset']))
+    ov = {'aff': B['aff'], 'full_shape': B['full_shape'], 'offset': lo}
+    ov['data'] = A['data'][a_sl] & B['data'][b_sl]
+    return ov
+
+# paste a (cropped) array of a prepared mask back into the full image grid, at write time
+def pasteFull(m, arr):
+    if arr.shape == tuple(m['full_shape']):
+        return arr
+    full = np.zeros(m['full_shape'], arr.dtype)
+    full[tuple(slice(o, o + sh) for o, sh in zip(m['offset'], arr.shape))] = arr
+    return full
+
+# a single voxel dilated 5x with the default cross structure
+marker = np.uint16(ndimage.morphology.binary_dilation(np.pad(np.ones((1, 1, 1)), 5), iterations=5))
+
+# marker image for a list of voxels
+# the same as setting the voxels to 1, a 5x binary dilation and the voxels to 10
+# but the marker is stamped locally instead of dilating the whole field of view
+def markerMap(shape, vox):
+    out = np.zeros(shape, np.uint16)
+    r = marker.shape[0] // 2
+    vox = np.int16(np.reshape(vox, (-1, 3)))
+    for v in vox:
+        lo = np.maximum(v - r, 0)
+        hi = np.minimum(v + r + 1, shape)
+        m_sl = tuple(slice(l - c + r, h - c + r) for l, h, c in zip(lo, hi, v))
+        o_sl = tuple(slice(l, h) for l, h in zip(lo, hi))
+        out[o_sl] = np.maximum(out[o_sl], marker[m_sl])
+    out[tuple(vox.T)] = 10
+    return out
+
+# run the chosen distance engine between the outlines of two prepared masks
+# returns the minimum distance, the indices of the tied voxel pairs,
+# the distance-to-B map (edt only, else None), the engine actually used
+# and the nearest neighbour data of the engine to reuse in surfaceDistances
+def minDist(A, B, mode='kdtree', max_mem=512):
+    dist_map = None
+    nn = {}
+    if mode == 'edt' and not isOrthogonal(B['aff']):
+        print('the affine has shear, the distance transform is not exact, falling back to kdtree')
+        mode = 'kdtree'
+    if mode == 'brute':
+        all_min, alidx = minDistBrute(A['xyz'], B['xyz'])
+    elif mode == 'edt':
+        all_min, alidx, dist_map, nn['tree'] = minDistEdt(pasteFull(B, B['outline']), pasteFull(B, B['data']), B['aff'], A['ijk'], A['xyz'], B['xyz'])
+    elif mode == 'blocked':
+        all_min, alidx = minDistBlocked(A['xyz'], B['xyz'], max_mem)
+    else:
+        all_min, alidx, nn['tree'], nn['d_ab'] = minDistKdtree(A['xyz'], B['xyz'])
+    return all_min, alidx, dist_map, mode, nn
+
+# the results of one mask A - mask B comparison, as returned by edsB2masks
+# distances are in mm, voxel (ijk) and mm (xyz) coordinates are (n, 3) arrays
+# the overlap fields are only filled if the masks initially overlap (wf 1)
+@dataclass
+class EDsResult:
+    mask_A: str = ''
+    mask_B: str = ''
+    mode: str = ''
+    overlap: bool = False
+    cogA_ijk: np.ndarray = None
+    cogA_xyz: np.ndarray = None
+    cogB_ijk: np.ndarray = None
+    cogB_xyz: np.ndarray = None
+    min_dist: float = None
+    minA_ijk: np.ndarray = None
+    minA_xyz: np.ndarray = None
+    minB_ijk: np.ndarray = None
+    minB_xyz: np.ndarray = None
+    cogs_dist: float = None
+    cogA_2_maskB_dist: float = None
+    cogA_2_maskB_ijk: np.ndarray = None
+    cogA_2_maskB_xyz: np.ndarray = None
+    cogB_2_maskA_dist: float = None
+    cogB_2_maskA_ijk: np.ndarray = None
+    cogB_2_maskA_xyz: np.ndarray = None
+    hd_AB: float = None
+    hd_BA: float = None
+    hd: float = None
+    hd95: float = None
+    asd_AB: float = None
+    asd_BA: float = None
+    assd: float = None
+    ov_count: int = None
+    ov_perc_A: float = None
+    ov_perc_B: float = None
+    ov_cog_ijk: np.ndarray = None
+    ov_cog_xyz: np.ndarray = None
+    ovCOG_2_maskA_dist: float = None
+    ovCOG_2_maskA_ijk: np.ndarray = None
+    ovCOG_2_maskA_xyz: np.ndarray = None
+    cogA_2_ov_dist: float = None
+    cogA_2_ov_ijk: np.ndarray = None
+    cogA_2_ov_xyz: np.ndarray = None
+    cogB_2_ov_dist: float = None
+    cogB_2_ov_ijk: np.ndarray = None
+    cogB_2_ov_xyz: np.ndarray = None
+    error: str = ''
+    # the distance-to-B map of the edt engine, not part of the json/csv output
+    dist_map: np.ndarray = field(default=None, repr=False)
+
+    # all measures as plain python types, for json
+    def asDict(self):
+        out = {}
+        for f in fields(self):
+            if f.name == 'dist_map':
+                continue
+            v = getattr(self, f.name)
+            if isinstance(v, (np.ndarray, np.generic)):
+                v = v.tolist()
+            elif isinstance(v, tuple):
+                v = [float(c) for c in v]
+            out[f.name] = v
+        return out
+
+    # one flat csv row, coordinates are given for the first tied voxel pair only
+    def asRow(self):
+        d = self.asDict()
+        row = {}
+        for key in csv_columns:
+            v = d.get(key)
+            if isinstance(v, list) and v and isinstance(v[0], list):
+                v = v[0]
+            if isinstance(v, list):
+                v = ' '.join(map(str, v))
+            row[key] = v
+        row['n_min_pairs'] = 0 if self.minA_ijk is None else self.minA_ijk.shape[0]
+        return row
+
+csv_columns = ['mask_A', 'mask_B', 'mode', 'overlap', 'min_dist', 'n_min_pairs', 'minA_ijk', 'minA_xyz', 'minB_ijk', 'minB_xyz', \
+    'cogA_xyz', 'cogB_xyz', 'cogs_dist', 'cogA_2_maskB_dist', 'cogB_2_maskA_dist', \
+    'hd_AB', 'hd_BA', 'hd', 'hd95', 'asd_AB', 'asd_BA', 'assd', \
+    'ov_count', 'ov_perc_A', 'ov_perc_B', 'ovCOG_2_maskA_dist', 'cogA_2_ov_dist', 'cogB_2_ov_dist', 'error']
+
+def writeJson(results, out_file):
+    with open(out_file, 'w') as file_handler:
+        json.dump([res.asDict() for res in results], file_handler, indent=2)
+
+def writeCsv(results, out_file):
+    with open(out_file, 'w', newline='') as file_handler:
+        writer = csv.DictWriter(file_handler, fieldnames=csv_columns)
+        writer.writeheader()
+        for res in results:
+            writer.writerow(res.asRow())
+
+# all distance measures between two prepared masks
+def computeEDs(A, B, mode='kdtree', max_mem=512):
+    res = EDsResult(mask_A=A['file'], mask_B=B['file'])
+    if not np.allclose(A['aff'], B['aff']):
+        raise ValueError('the affines of the inputs are not matching')
+    aff2 = B['aff']
+    ijk1 = A['ijk']
+    ijk2 = B['ijk']
+    xyz1 = A['xyz']
+    xyz2 = B['xyz']
+    cog1_xyz = A['cog_xyz']
+    cog2_xyz = B['cog_xyz']
+    res.cogA_ijk = A['cog']
+    res.cogA_xyz = cog1_xyz
+    res.cogB_ijk = B['cog']
+    res.cogB_xyz = cog2_xyz
+
+    # here we start checking for initial overlaps
+    # if this is found we can follow a different workflow
+    # where the overlap voxels COG is calculated
+    # and we continue while focusing on those instead of the whole image
+    OV = overlapMask(A, B)
+    in_overlap = OV['data']
+    res.overlap = bool(np.any(in_overlap))
+
+    # what is the distance between the COGs of both masks
+    res.cogs_dist = np.linalg.norm(cog1_xyz-cog2_xyz)
+
+    # calculate cog2 distance to every voxel in in1
+    # and cog1 distance to every voxel in in2
+    cog2_ds = np.float32(np.linalg.norm(xyz1 - cog2_xyz, axis=1))
+    cog1_ds = np.float32(np.linalg.norm(xyz2 - cog1_xyz, axis=1))
+
+    # calculate the minimum distance between every voxel in in1 to in2
+    # and find index of min distance entries
+    res.min_dist, alidx, res.dist_map, res.mode, nn = minDist(A, B, mode, max_mem)
+
+    # grab the coordinates of the voxels giving shortest ds from both masks
+    res.minA_xyz = xyz1[alidx[0]]
+    res.minA_ijk = ijk1[alidx[0]]
+    res.minB_xyz = xyz2[alidx[1]]
+    res.minB_ijk = ijk2[alidx[1]]
+
+    # find min ds
+    # and coordinates in vox and mm of the voxels with shortest distances
+    res.cogA_2_maskB_dist = np.amin(cog1_ds)
+    res.cogB_2_maskA_dist = np.amin(cog2_ds)
+    res.cogA_2_maskB_ijk = ijk2[np.where(cog1_ds == res.cogA_2_maskB_dist)]
+    res.cogA_2_maskB_xyz = xyz2[np.where(cog1_ds == res.cogA_2_maskB_dist)]
+    res.cogB_2_maskA_ijk = ijk1[np.where(cog2_ds == res.cogB_2_maskA_dist)]
+    res.cogB_2_maskA_xyz = xyz1[np.where(cog2_ds == res.cogB_2_maskA_dist)]
+
+    # Hausdorff, HD95 and average symmetric surface distance between the outlines
+    for key, value in surfaceDistances(xyz1, xyz2, nn).items():
+        setattr(res, key, value)
+
+    # if the initial overlap is zero we are done
+    # if not we look at the overlapping voxels
+    # mask B voxels overlapping with mask A
+    # get their COG
+    # calculate distance between COGA and COG of maskB voxels overlapping with maskA (and vice versa?)
+    # also calculate percentage of maskB overlapping with maskA and vice versa
+    if res.overlap:
+        # to get the count, indices and coordinates of overlapping voxels
+        res.ov_count = np.count_nonzero(in_overlap)
+        ov_ijk = np.argwhere(in_overlap) + OV['offset']
+        ov_xyz = nib.affines.apply_affine(aff2, ov_ijk) # this actually works
+
+        res.ov_cog_ijk = tuple(c + o for c, o in zip(ndimage.measurements.center_of_mass(in_overlap), OV['offset']))
+        res.ov_cog_xyz = nib.affines.apply_affine(aff2, res.ov_cog_ijk)
+
+        # dist. between all maskA voxels and ov_COG
+        ov_cog_2_maskAv_ds = np.float32(np.linalg.norm(xyz1 - res.ov_cog_xyz, axis=1))
+        # dist. between all ov voxels and maskA_COG and maskB_COG, in one pass over the ov voxels
+        OVv_2_COGs_ds = np.float32(np.linalg.norm(ov_xyz[:, None, :] - np.vstack((cog1_xyz, cog2_xyz))[None, :, :], axis=2))
+        OVv_2_maskACOG_ds = OVv_2_COGs_ds[:, 0]
+        OVv_2_maskBCOG_ds = OVv_2_COGs_ds[:, 1]
+
+        # find mins
+        res.ovCOG_2_maskA_dist = np.amin(ov_cog_2_maskAv_ds)
+        res.cogA_2_ov_dist = np.amin(OVv_2_maskACOG_ds)
+        res.cogB_2_ov_dist = np.amin(OVv_2_maskBCOG_ds)
+
+        # to get array indices of min values
+        idx_1 = np.where(ov_cog_2_maskAv_ds == res.ovCOG_2_maskA_dist)
+        idx_2 = np.where(OVv_2_maskACOG_ds == res.cogA_2_ov_dist)
+        idx_3 = np.where(OVv_2_maskBCOG_ds == res.cogB_2_ov_dist)
+
+        # to get actual coordinates
+        res.ovCOG_2_maskA_xyz = xyz1[idx_1[0]]
+        res.ovCOG_2_maskA_ijk = ijk1[idx_1[0]]
+        res.cogA_2_ov_xyz = ov_xyz[idx_2[0]]
+        res.cogA_2_ov_ijk = ov_ijk[idx_2[0]]
+        res.cogB_2_ov_xyz = ov_xyz[idx_3[0]]
+        res.cogB_2_ov_ijk = ov_ijk[idx_3[0]]
+
+        # calc percent overlap, overlapping voxels relative to the voxels of each mask
+        res.ov_perc_B = 100.0 * np.float32(res.ov_count) / np.float32(np.count_nonzero(B['data']))
+        res.ov_perc_A = 100.0 * np.float32(res.ov_count) / np.float32(np.count_nonzero(A['data']))
+
+    return res
+
+def printResult(res):
+    if res.overlap:
+        print('overlap found')
+    else:
+        print('overlap not found')
+    print('COG of mask A in mm:', res.cogA_xyz, 'in voxels: ', res.cogA_ijk)
+    print('COG of mask B in mm:', res.cogB_xyz, 'in voxels: ', res.cogB_ijk)
+    print('Minimum distance between all voxels of mask A and all voxels of mask B = ', res.min_dist)
+    print('Number of voxel pairs at this minimum distance = ', res.minA_ijk.shape[0])
+    print('Minimum distance between COG of mask A and all voxels of mask B = ', res.cogA_2_maskB_dist)
+    print('Minimum distance between COG of mask B and all voxels of mask A = ', res.cogB_2_maskA_dist)
+    print('Minimum distance between COG of mask A and COG of mask B = ', (res.cogs_dist))
+    print('Hausdorff distance between mask A and mask B = ', res.hd, '(A to B ', res.hd_AB, ', B to A ', res.hd_BA, ')')
+    print('95th percentile Hausdorff distance between mask A and mask B = ', res.hd95)
+    print('Average symmetric surface distance between mask A and mask B = ', res.assd, '(A to B ', res.asd_AB, ', B to A ', res.asd_BA, ')')
+    if res.overlap:
+        print('Minimum distance between COG of overlapping voxels and all voxels of mask A = ', res.ovCOG_2_maskA_dist , 'mm')
+        print('Minimum distance between COG of mask A and all overlapping voxels = ', res.cogA_2_ov_dist , 'mm')
+        print('Minimum distance between COG of mask B and all overlapping voxels = ', res.cogB_2_ov_dist , 'mm')
+        print('Number of overlapping voxels between both masks: ', str(res.ov_count), ' voxels')
+        print('Percent volume overlap between masks relative to mask A = ', str(res.ov_perc_A).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", ""), '%')
+        print('Percent volume overlap between masks relative to mask B = ', str(res.ov_perc_B).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", ""), '%')
+
+# get basename of input files
+# assuming the sub-* naming convention is used
+def subjectTag(in1):
+    subs = list(filter(lambda x: ('sub-') in x, (in1.split('/'))))
+    if not subs:
+        return ''
+    return ('_' + str(str(subs[0]).split('_')[0]).split('-')[1])
+
+# the free text measures file, as before
+def writeMeasures(res, out_file):
+    if res.overlap:
+        # need to propagate to results text file then append later results to it without overwriting
+        with open(out_file, "w" ) as file_handler:
+            file_handler.write('Initial overlap found between both masks, distance calculations using overlapping voxels, their COG, as well as external outlines and COGs of both masks' + '\n' + \
+            '\n' + \
+            'Minimum distance between COG of overlapping voxels and all voxels of mask A = ' + str(res.ovCOG_2_maskA_dist).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+            'Minimum distance between COG of mask A and all overlapping voxels = ' + str(res.cogA_2_ov_dist).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+            'Minimum distance between COG of mask B and all overlapping voxels = ' + str(res.cogB_2_ov_dist).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
+            '\n' + \
+            'Number of overlapping voxels between both masks: ' + str(res.ov_count) + ' voxels' + '\n' + \
+            'Percent volume overlap between masks relative to mask A = ' + str(res.ov_perc_A) + '%' + '\n' + \
+            'Percent volume overlap between masks relative to mask B = ' + str(res.ov_perc_B) + '%' + '\n' \
+            '\n')
+    else:
+        with open(out_file, "w" ) as file_handler:
+            file_handler.write('No overlap found between both masks, distance calculations done using external outlines and COGs only' + '\n' + '\n')
+
+    # save output measures to a text file
+    with open(out_file, "a+" ) as file_handler:
+        file_handler.write('Minimum distance between all voxels of mask A and mask B: ' + \
+            str(res.min_dist) + 'mm \n' + \
+            'This is found between:- ' + '\n' + \
+            'Mask A voxel at voxel coordinates: ' + str(res.minA_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'Mask A voxel at mm coordinates: ' + str(res.minA_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' \
+            'Mask B voxel at voxel coordinates: ' + str(res.minB_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'Mask B voxel at mm coordinates: ' + str(res.minB_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            '\n' + \
+            'Minimum distance between COG of mask A and COG of mask B: ' + str(res.cogs_dist) + 'mm \n' + \
+            'COG of mask A voxel coordinates: ' + str(res.cogA_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'COG of mask A mm coordinates: ' + str(res.cogA_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'COG of mask B voxel coordinates :' + str(res.cogB_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'COG of mask B mm coordinates: ' + str(res.cogB_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            '\n' + \
+            'Minimum distance between COG of mask A and all voxels of mask B: ' + str(res.cogA_2_maskB_dist) + 'mm \n' + \
+            'Mask B voxel(s) with shortest distance to mask A COG voxel coordinates: ' + str(res.cogA_2_maskB_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'Mask B voxel(s) with shortest distance to mask A COG mm coordinates: ' + str(res.cogA_2_maskB_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            '\n' + \
+            'Minimum distance between COG of mask B and all voxels of mask A: ' + str(res.cogB_2_maskA_dist) + 'mm \n' + \
+            'Mask A voxel(s) with shortest distance to mask B COG voxel coordinates: ' + str(res.cogB_2_maskA_ijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            'Mask A voxel(s) with shortest distance to mask B COG mm coordinates: ' + str(res.cogB_2_maskA_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
+            '\n' + \
+            'Hausdorff distance between mask A and mask B: ' + str(res.hd) + 'mm \n' + \
+            'Directed Hausdorff distance from mask A to mask B: ' + str(res.hd_AB) + 'mm \n' + \
+            'Directed Hausdorff distance from mask B to mask A: ' + str(res.hd_BA) + 'mm \n' + \
+            '95th percentile Hausdorff distance between mask A and mask B: ' + str(res.hd95) + 'mm \n' + \
+            'Average symmetric surface distance between mask A and mask B: ' + str(res.assd) + 'mm \n' + \
+            'Average surface distance from mask A to mask B: ' + str(res.asd_AB) + 'mm \n' + \
+            'Average surface distance from mask B to mask A: ' + str(res.asd_BA) + 'mm \n' + \
+            '\n' + \
+            'Number of voxel pairs at the minimum distance between mask A and mask B: ' + str(res.minA_ijk.shape[0]) + '\n')
+        # every tied pair on its own line
+        for pp in range(0, res.minA_ijk.shape[0]):
+            file_handler.write('Pair ' + str(pp + 1) + ': mask A voxel ' + ', '.join(map(str, res.minA_ijk[pp])) + \
+                ' (mm ' + ', '.join('%.3f' % c for c in res.minA_xyz[pp]) + ')' + \
+                ' - mask B voxel ' + ', '.join(map(str, res.minB_ijk[pp])) + \
+                ' (mm ' + ', '.join('%.3f' % c for c in res.minB_xyz[pp]) + ')' + '\n')
+
+# output levels to choose from with -l
+# minimal = numbers only (text, json, csv), no nifti images
+# standard = the result images: COG and min distance markers, overlap maps and the distance-to-B map
+# full = standard plus copies of the masks, their erosions and edges (as before)
+levels = ['minimal', 'standard', 'full']
+
+# the nifti output: masks, edges, erosions, COG and min distance markers and overlap maps
+# prefix is the output path up to and including the subject tag
+# every image is a job (suffix, affine, function making the array) that is built, compressed and saved
+# by a thread pool (zlib releases the GIL), compress is a gzip level 1-9 or 'none' for uncompressed .nii
+def writeImages(res, A, B, prefix, level='full', compress=1, ncpu=None):
+    aff1 = A['aff']
+    aff2 = B['aff']
+    jobs = []
+    if level == 'minimal':
+        return
+    if res.overlap:
+        OV = overlapMask(A, B)
+
+        # the overlap array already is the map of all ov_voxels
+        jobs.append(('_initial_overlapping_voxels', aff2, lambda: np.uint16(pasteFull(OV, OV['data']))))
+        # Create array for ov_COG image and dilate
+        jobs.append(('_initial_overlapping_voxels_COG', aff2, lambda: markerMap(OV['full_shape'], res.ov_cog_ijk)))
+        # create array for ov_COG 2 maskA_voxels
+        jobs.append(('_maskA_vox_mindist_2_overlap_COG', aff1, lambda: markerMap(A['full_shape'], res.ovCOG_2_maskA_ijk[0])))
+        # create array for ov voxels to maskA COG
+        jobs.append(('_overlap_vox_mindist_2_mask_A_COG', aff2, lambda: markerMap(OV['full_shape'], res.cogA_2_ov_ijk[0])))
+        # create array for ov voxels to maskB COG
+        jobs.append(('_overlap_vox_mindist_2_mask_B_COG', aff2, lambda: markerMap(OV['full_shape'], res.cogB_2_ov_ijk[0])))
+
+    if level == 'full':
+        # Save intermediate images to nii.gz in output dir
+        jobs.append(('_mask_A_edge', aff1, lambda: np.uint16(pasteFull(A, A['outline']))))
+        jobs.append(('_mask_B_edge', aff2, lambda: np.uint16(pasteFull(B, B['outline']))))
+
+        # needs a better cleanup strategy than simple morpho closure
+        # potential helpful option -> https://www.delftstack.com/howto/python/smooth-data-in-python/
+        # jobs.append(('_mask_A_cleaned', aff1, lambda: clean_im1))
+        # jobs.append(('_mask_B_cleaned', aff2, lambda: clean_im2))
+
+        jobs.append(('_mask_A', aff1, lambda: np.uint16(pasteFull(A, A['data']))))
+        jobs.append(('_mask_B', aff2, lambda: np.uint16(pasteFull(B, B['data']))))
+
+        jobs.append(('_mask_A_eroded', aff1, lambda: np.uint16(pasteFull(A, A['eroded']))))
+        jobs.append(('_mask_B_eroded', aff2, lambda: np.uint16(pasteFull(B, B['eroded']))))
+
+    # the distance-to-B field in mm from the edt engine
+    if res.dist_map is not None:
+        jobs.append(('_distance_2_mask_B', aff2, lambda: res.dist_map))
+
+    # save voxels of min distances to two different images
+    # save voxels of min distances to the same image or different images ??
+    # all tied voxels are marked
+    jobs.append(('_mask_A_vox_mindist_2_all_B_mask_vox', aff1, lambda: markerMap(A['full_shape'], res.minA_ijk)))
+    jobs.append(('_mask_B_vox_mindist_2_all_A_mask_vox', aff2, lambda: markerMap(B['full_shape'], res.minB_ijk)))
+    jobs.append(('_mask_A_COG', aff1, lambda: markerMap(A['full_shape'], res.cogA_ijk)))
+    jobs.append(('_mask_B_COG', aff2, lambda: markerMap(B['full_shape'], res.cogB_ijk)))
+
+    if compress == 'none':
+        ext = '.nii'
+    else:
+        ext = '.nii.gz'
+
+    # the gzip stream is opened here with the level of this call, nibabel's global default level is not touched
+    # so concurrent edsB2masks calls with different levels do not interfere
+    def saveJob(job):
+        suffix, aff, make = job
+        img = nib.Nifti1Image(make(), aff)
+        out_file = prefix + suffix + ext
+        if compress == 'none':
+            nib.save(img, out_file)
+        else:
+            with gzip.open(out_file, 'wb', compresslevel=int(compress)) as file_handler:
+                img.to_file_map({'image': nib.FileHolder(filename=out_file, fileobj=file_handler)})
+
+    with ThreadPoolExecutor(max_workers=ncpu) as pool:
+        list(pool.map(saveJob, jobs))
+
+# importable entry point
+# compares two masks and returns an EDsResult
+# if out is given the measures text file (and the formats in formats: 'json', 'csv')
+# and the nifti images of the output level are written to <out_dir>/<out>_output, out_dir defaults to the working directory
+# e.g.
+#   from KUL_EDs_b2masks import edsB2masks
+#   res = edsB2masks('sub-01_sphere.nii.gz', 'sub-01_CST.nii.gz')
+#   print(res.min_dist)
+def edsB2masks(in1, in2, out=None, mode='kdtree', max_mem=512, margin=None, formats=(), out_dir=None, \
+    level='full', compress=1, ncpu=None):
+    if mode not in modes:
+        raise ValueError('unknown distance mode ' + str(mode) + ', choose one of ' + str(modes))
+    if level not in levels:
+        raise ValueError('unknown output level ' + str(level) + ', choose one of ' + str(levels))
+    # now we load in the niis
+    # and prepare their edges, COGs and coordinates
+    A = prepareMask(in1, margin)
+    B = prepareMask(in2, margin)
+    res = computeEDs(A, B, mode, max_mem)
+    if out is not None:
+        if out_dir is None:
+            out_dir = os.getcwd()
+        out_path = os.path.join(out_dir, out + '_output')
+        os.makedirs(out_path, exist_ok=True)
+        nm = subjectTag(in1)
+        measures = os.path.join(out_path, out + '_output' + nm + '_output_measures')
+        writeMeasures(res, measures + '.txt')
+        if 'json' in formats:
+            writeJson([res], measures + '.json')
+        if 'csv' in formats:
+            writeCsv([res], measures + '.csv')
+        writeImages(res, A, B, os.path.join(out_path, out + nm), level, compress, ncpu)
+    return res
+
+# batch mode, one mask A against many masks B
+# mask A is prepared once and handed to every worker process when it starts
+batch_A = {}
+
+def batchInit(A):
+    global batch_A
+    batch_A = A
+
+def batchWorker(in2, mode, max_mem, margin):
+    B = prepareMask(in2, margin)
+    res = computeEDs(batch_A, B, mode, max_mem)
+    # no images are written in batch mode, do not send the full volume distance map of edt back
+    res.dist_map = None
+    return res
+
+# precompute mask A once, spread the B masks over a process pool
+# and write one consolidated csv table (no nifti output in batch mode)
+def runBatch(in1, in2_list, out_n, mode, max_mem, ncpu, margin=None, formats=()):
+    A = prepareMask(in1, margin)
+    print('Mask A prepared, running against', len(in2_list), 'B masks on', ncpu, 'cpus')
+    results = []
+    with ProcessPoolExecutor(max_workers=ncpu, initializer=batchInit, initargs=(A,)) as pool:
+        futures = [pool.submit(batchWorker, in2, mode, max_mem, margin) for in2 in in2_list]
+        for in2, future in zip(in2_list, futures):
+            try:
+                res = future.result()
+            except Exception as e:
+                res = EDsResult(mask_A=in1, mask_B=in2, error=str(e))
+            if res.error:
+                print(os.path.basename(in2), 'failed:', res.error)
+            else:
+                print(os.path.basename(in2), 'minimum distance', res.min_dist, 'mm')
+            results.append(res)
+    out_dir = os.path.join(os.getcwd(), out_n + '_output')
+    os.makedirs(out_dir, exist_ok=True)
+    out_csv = os.path.join(out_dir, out_n + '_batch_results.csv')
+    writeCsv(results, out_csv)
+    print('Batch results written to', out_csv)
+    if 'json' in formats:
+        writeJson(results, os.path.join(out_dir, out_n + '_batch_results.json'))
 
 # define main input function here
 def main(argv):
-    ilog = ''
-    inii = ''
-    iname = ''
-    ofolder = ''
+    mode = 'kdtree'
+    max_mem = 512
+    in2_list = []
+    in2_given = False
+    ncpu = os.cpu_count()
+    margin = None
+    formats = []
+    out = 'KUL_EDs'
+    level = 'full'
+    compress = '1'
     try:
-        opts, args = getopt.getopt(argv,"ha:b:o:",["in1=","in2=","o="])
+        opts, args = getopt.getopt(argv,"ha:b:B:o:m:M:j:c:f:l:z:",["in1=","in2=","in2_list=","o=","mode=","max_mem=","ncpu=","crop=","format=","level=","compress="])
     except getopt.GetoptError:
-        print ('KUL_EDs_b2masks.py -a <in1> -b <in2> -o <out>')
+        print ('KUL_EDs_b2masks.py -a <in1> -b <in2> -o <out> -m <mode> -M <max_mem>')
+        print ('KUL_EDs_b2masks.py -a <in1> -B <in2_list> -o <out> -m <mode> -M <max_mem> -j <ncpu>')
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
@@ -46,7 +738,21 @@ def main(argv):
             print ('KUL_EDs_b2masks.py will also check for initial overlap and calculate distances to and from overlapping voxels as well')
             print ('The two input masks must be in the same space and have the same dimensions')
             print ('The first mask should be the smaller one (e.g. DES sphere, or lesion mask), and the second the larger (e.g. CST)')
-            print ('KUL_EDs_between_2masks.py -a <in1> -b <in2> -o <out>')
+            print ('The distance engine is chosen with -m: kdtree (default, fast), edt (distance transform, also saves a distance-to-B map), blocked (bounded memory) or brute (reference, slow)')
+            print ('The memory ceiling in MB of the blocked engine is set with -M (default 512)')
+            print ('All voxel pairs tied at the minimum distance are reported')
+            print ('Surface distance metrics between the outlines (directed and symmetric Hausdorff, HD95, ASSD) are always reported')
+            print ('Batch mode: -B takes a glob or comma separated list of second masks (e.g. "TCK_maps/*_fin_BT_map_inNat.nii.gz")')
+            print ('  the first mask is prepared once, the second masks are spread over -j processes (default all cpus)')
+            print ('  and the results are written to one csv table')
+            print ('Cropped processing: -c <margin> crops each mask to its bounding box plus margin voxels')
+            print ('  erosion, COG and markers run on the subvolume, results are pasted back in the full image when written')
+            print ('Machine readable output: -f json,csv writes the measures also as json and/or csv next to the text file')
+            print ('Output level -l: minimal (numbers only), standard (result images) or full (default, also mask copies, erosions and edges)')
+            print ('  images are written concurrently (-j threads), -z sets the gzip level 1-9 (default 1) or none for uncompressed .nii')
+            print ('The computation can also be imported: from KUL_EDs_b2masks import edsB2masks')
+            print ('KUL_EDs_between_2masks.py -a <in1> -b <in2> -o <out> -m <mode> -M <max_mem> -c <margin> -f <formats> -l <level> -z <compress> -j <ncpu>')
+            print ('KUL_EDs_between_2masks.py -a <in1> -B <in2_list> -o <out> -m <mode> -M <max_mem> -c <margin> -f <formats> -j <ncpu>')
             sys.exit()
         elif opt in ("-a", "--in1"):
             in1 = arg
@@ -54,9 +760,49 @@ def main(argv):
             in2 = arg
         elif opt in ("-o", "--out"):
             out = arg
+        elif opt in ("-m", "--mode"):
+            mode = arg
+        elif opt in ("-M", "--max_mem"):
+            max_mem = float(arg)
+        elif opt in ("-B", "--in2_list"):
+            in2_given = True
+            for item in arg.split(','):
+                matched = sorted(glob.glob(item))
+                if not matched:
+                    print ('Warning: "', item, '" of the second mask list matches no files, skipping it')
+                in2_list.extend(matched)
+        elif opt in ("-j", "--ncpu"):
+            ncpu = int(arg)
+        elif opt in ("-c", "--crop"):
+            # the erosion needs at least one background voxel around the mask
+            margin = max(1, int(arg))
+        elif opt in ("-f", "--format"):
+            formats = arg.split(',')
+        elif opt in ("-l", "--level"):
+            level = arg
+        elif opt in ("-z", "--compress"):
+            compress = arg
+    if mode not in modes:
+        print ('Unknown distance mode "', mode, '", choose one of ', modes)
+        sys.exit(2)
+    if level not in levels:
+        print ('Unknown output level "', level, '", choose one of ', levels)
+        sys.exit(2)
+    if compress != 'none':
+        if not compress.isdigit() or not 1 <= int(compress) <= 9:
+            print ('Unknown compression "', compress, '", choose 1-9 or none')
+            sys.exit(2)
+        compress = int(compress)
+    if in2_given and not in2_list:
+        print ('The second mask list (-B) matches no files, exiting')
+        sys.exit(2)
+    if in2_list:
+        runBatch(in1, in2_list, out, mode, max_mem, ncpu, margin, formats)
+        return
     print ('Input full path and file name for the first mask image "', in1)
     print ('Input full path and file name for the second mask image "', in2)
     print ('Prefix output name "', out)
+    print ('Distance mode "', mode)
 
     # for debugging
     # in1 = '/media/radwan/AR_16T/S61759_BIDS_fMRI/BIDS/derivatives/Warping_2_native/ECS/sub-PT004_ECS2nat/sub-PT004_ECS_split/Spheres_split_2_reconned.nii.gz'
@@ -64,326 +810,13 @@ def main(argv):
     # in2 = '/media/radwan/AR_16T/S61759_BIDS_fMRI/BIDS/derivatives/Warping_2_native/TCKs/sub-PT004_TCKs_warping/TCK_maps/AF_all_all_LT_fin_BT_map_inNat.nii.gz'
     # out = 'Alpha_trial'
 
-    # now we load in the niis
-    img1 = nib.load(in1)
-    img2 = nib.load(in2)
-
-    # grab their affines
-    aff1 = img1.affine
-    aff2 = img2.affine
-
     # sanity check, are the affines the same or close enough ?
-    if np.allclose(aff1, aff2):
-        # for each input convert fdata to 16bit uint
-        # then do a 1x iterative cleaning, 1x erosion, absolute difference is the edge
-        im1_data = np.uint16(img1.get_fdata())
-        im2_data = np.uint16(img2.get_fdata())
-
-        # here we start checking for initial overlaps
-        # if this is found we can follow a different workflow
-        # where the overlap voxels COG is calculated
-        # and we continue while focusing on those instead of the whole image
-        in_overlap = np.uint16(np.multiply(im1_data, im2_data))
-
-        # if the initial overlap is zero we do the wf described above
-        # if not we look at the overlapping voxels
-        # mask B voxels overlapping with mask A
-        # get their COG
-        # calculate distance between COGA and COG of maskB voxels overlapping with maskA (and vice versa?)
-        # also calculate percentage of maskB overlapping with maskA and vice versa
-        if np.amax(in_overlap) != 0:
-            wf = 1
-            print('overlap found')
-        else:
-            wf = 2
-            print('overlap not found')
-
-        # clean_im1 = np.uint16(ndimage.morphology.binary_dilation((ndimage.morphology.binary_erosion \
-        #     (im1_data, iterations=2)), iterations=1))
-        
-        eroded_im1 = np.uint16(ndimage.morphology.binary_erosion(im1_data))
-        eroded_im2 = np.uint16(ndimage.morphology.binary_erosion(im2_data))
-
-        # clean_im2 = np.uint16(ndimage.morphology.binary_dilation((ndimage.morphology.binary_erosion \
-        #     (im2_data, iterations=2)), iterations=1))
-        
-        outline1 = np.uint16(np.absolute(np.subtract(im1_data,eroded_im1)))
-        outline2 = np.uint16(np.absolute(np.subtract(im2_data,eroded_im2)))
-        
-        # to get indices of nonzero voxels
-        img1_idx = np.where(outline1)
-        img2_idx = np.where(outline2)
-
-        # to get cogs in voxel coords
-        cog1 = ndimage.measurements.center_of_mass(im1_data)
-        cog2 = ndimage.measurements.center_of_mass(im2_data)
-        # then convert voxel coords to mm
-        cog1_xyz = nib.affines.apply_affine(aff1, cog1)
-        cog2_xyz = nib.affines.apply_affine(aff2, cog2)
-
-        # list of arrays to (voxels, 3) array
-        ijk1 = np.vstack(img1_idx).T
-        ijk2 = np.vstack(img2_idx).T
-
-        # convert the voxel coordinates to mm coordinates
-        xyz1 = nib.affines.apply_affine(aff1, ijk1)
-        xyz2 = nib.affines.apply_affine(aff2, ijk2)
-
-        # declare empty numpy arrays
-        # to enable recovery of voxel coordinates afterwards
-        results = np.zeros((ijk1.shape[0], ijk2.shape[0]), np.float32)
-        cog1_ds = np.zeros((ijk2.shape[0]), np.float32)
-        cog2_ds = np.zeros((ijk1.shape[0]), np.float32)
-
-        vox_A_maps = np.zeros(im1_data.shape, np.uint16)
-        vox_B_maps = np.zeros(im2_data.shape, np.uint16)
-        COGA_map = np.zeros(im1_data.shape, np.uint16)
-        COGB_map = np.zeros(im2_data.shape, np.uint16)
-
-        # what is the distance between the COGs of both masks
-        cogs_d = np.linalg.norm(cog1_xyz-cog2_xyz)
-
-        # loop 1 over in1 nonzero voxel mm coordinates
-        # calculate cog2 distance to every voxel in in1
-        # loop 2 over in2 nonzero voxel mm coordinates
-        # calculate distances between every voxel in in1 to in2
-        for ii in range(0,xyz1.shape[0]):
-            cog2_ds[ii] = np.linalg.norm(cog2_xyz-xyz1[ii])
-            for jj in range(0,xyz2.shape[0]):
-                results[ii,jj] = np.linalg.norm(xyz1[ii]-xyz2[jj])
-                
-
-        # loop 3 over nonzero voxels in in2
-        # calculate distances between cog1 and every voxel in in2
-        for uu in range(0,xyz2.shape[0]):
-            cog1_ds[uu] = np.linalg.norm(cog1_xyz-xyz2[uu])
-
-
-        # convert all to numpy arrays for safety
-        # find min ds
-        all_min = (np.amin(results))
-        coga_2b = (np.amin(cog1_ds))
-        cogb_2a = (np.amin(cog2_ds))
-
-        # find index of min distance entry
-        alidx = np.where(results == all_min)
-        
-        # grab the coordinates of the voxels giving shortest ds from both masks
-        a_vox_mm = xyz1[alidx[0]]
-        a_vox_vv = ijk1[alidx[0]]
-        b_vox_mm = xyz2[alidx[1]]
-        b_vox_vv = ijk2[alidx[1]]
-        
-        # find coordinates in vox and mm of the voxels with shortest distances
-        ca2bijk = ijk2[np.where(cog1_ds == coga_2b)]
-        ca2bxyz = xyz2[np.where(cog1_ds == coga_2b)]
-        cb2aijk = ijk1[np.where(cog2_ds == cogb_2a)]
-        cb2axyz = xyz1[np.where(cog2_ds == cogb_2a)]
-
-        print('COG of mask A in mm:', cog1_xyz, 'in voxels: ', cog1)
-        print('COG of mask B in mm:', cog2_xyz, 'in voxels: ', cog2)
-        print('Minimum distance between all voxels of mask A and all voxels of mask B = ', all_min)
-        print('Minimum distance between COG of mask A and all voxels of mask B = ', coga_2b)
-        print('Minimum distance between COG of mask B and all voxels of mask A = ', cogb_2a)
-        print('Minimum distance between COG of mask A and COG of mask B = ', (cogs_d))
-
-        # define output dirs and files
-        pwd = str(os.popen('pwd').read()).strip()
-
-        # is the output given?
-        if 'out' in locals():
-            out_n = out
-        else:
-            out_n = 'KUL_EDs'
-
-
-        # make output dir
-        os.system('mkdir -p ' + pwd + '/' + out_n + '_output')
-
-        # get basename of input files
-        # assuming the sub-* naming convention is used
-        nm = ('_' + str(str(list(filter(lambda x: ('sub') in x, (in1.split('/'))))[0]).split('_')[0]).split('-')[1])
-
-        # handle workflows
-        if wf == 1:
-            # to get the count, indices and coordinates of overlapping voxels
-            ov_count = np.count_nonzero(in_overlap)
-            ov_idx = np.where(in_overlap)
-            ov_ijk = np.vstack(ov_idx).T
-            ov_xyz = nib.affines.apply_affine(aff2, ov_ijk) # this actually works
-
-            ov_cog_ijk = ndimage.measurements.center_of_mass(in_overlap)
-            ov_cog_xyz = nib.affines.apply_affine(aff2, ov_cog_ijk)
-
-            # create empty arrays for distances
-            ov_cog_2_maskAv_ds = np.zeros((ijk1.shape[0]), np.float32) # for ov COG to mask A voxels
-            OVv_2_maskACOG_ds = np.zeros((ov_ijk.shape[0]), np.float32) # for ov voxels to COGA
-            OVv_2_maskBCOG_ds = np.zeros((ov_ijk.shape[0]), np.float32) # for ov voxels to COGB
-
-            # create empty arrays for voxel maps
-            ov_cog_2_maskAv_map = np.zeros(im1_data.shape, np.uint16)
-            OVv_2_maskACOG_map = np.zeros(in_overlap.shape, np.uint16)
-            OVv_2_maskBCOG_map = np.zeros(in_overlap.shape, np.uint16)
-
-            ov_Vox_map = np.zeros(in_overlap.shape, np.uint16) # for mapping the overlapping voxels to image
-            ov_Vox_COG_map = np.zeros(in_overlap.shape, np.uint16) # for mapping COG of overlapping voxels
-
-
-            # loop 1 to get dist. between all maskA voxels and ov_COG
-            for ww in range(0,xyz1.shape[0]):
-                ov_cog_2_maskAv_ds[ww] = np.linalg.norm(xyz1[ww]-ov_cog_xyz)
-
-
-            # loop 2 to get dist. between all ov voxels and maskA_COG
-            for ff in range(0,ov_xyz.shape[0]):
-                OVv_2_maskACOG_ds[ff] = np.linalg.norm(ov_xyz[ff]-cog1_xyz)
-                OVv_2_maskBCOG_ds[ff] = np.linalg.norm(ov_xyz[ff]-cog2_xyz)
-
-            # find mins
-            min_AvsOVCOG_d = np.amin(ov_cog_2_maskAv_ds)
-            min_OV2ACOG_d = np.amin(OVv_2_maskACOG_ds)
-            min_OV2BCOG_d = np.amin(OVv_2_maskBCOG_ds)
-
-            # to get array indices of min values
-            idx_1 = np.where(ov_cog_2_maskAv_ds == min_AvsOVCOG_d)
-            idx_2 = np.where(OVv_2_maskACOG_ds == min_OV2ACOG_d)
-            idx_3 = np.where(OVv_2_maskBCOG_ds == min_OV2BCOG_d)
-
-            # to get actual coordinates
-            ca_vox_mm = xyz1[idx_1[0]]
-            ca_vox_vv = ijk1[idx_1[0]]
-            cb_vox_mm = ov_xyz[idx_2[0]]
-            cb_vox_vv = ov_ijk[idx_2[0]]
-            cc_vox_mm = ov_xyz[idx_3[0]]
-            cc_vox_vv = ov_ijk[idx_3[0]]
-
-            # create array for ov_COG 2 maskA_voxels
-            ov_cog_2_maskAv_map[np.int16(ca_vox_vv[0][0]), np.int16(ca_vox_vv[0][1]), np.int16(ca_vox_vv[0][2])] = 1
-            dil_11 = np.uint16(ndimage.morphology.binary_dilation(ov_cog_2_maskAv_map, iterations=5))
-            dil_11[np.int16(ca_vox_vv[0][0]), np.int16(ca_vox_vv[0][1]), np.int16(ca_vox_vv[0][2])] = 10
-            # create array for ov voxels to maskA COG
-            OVv_2_maskACOG_map[np.int16(cb_vox_vv[0][0]), np.int16(cb_vox_vv[0][1]), np.int16(cb_vox_vv[0][2])] = 1
-            dil_22 = np.uint16(ndimage.morphology.binary_dilation(OVv_2_maskACOG_map, iterations=5))
-            dil_22[np.int16(cb_vox_vv[0][0]), np.int16(cb_vox_vv[0][1]), np.int16(cb_vox_vv[0][2])] = 10
-            # create array for ov voxels to maskB COG
-            OVv_2_maskBCOG_map[np.int16(cc_vox_vv[0][0]), np.int16(cc_vox_vv[0][1]), np.int16(cc_vox_vv[0][2])] = 1
-            dil_33 = np.uint16(ndimage.morphology.binary_dilation(OVv_2_maskBCOG_map, iterations=5))
-            dil_33[np.int16(cc_vox_vv[0][0]), np.int16(cc_vox_vv[0][1]), np.int16(cc_vox_vv[0][2])] = 10
-
-            # Create array for ov_COG image and dilate
-            ov_Vox_COG_map[np.int16(ov_cog_ijk[0]), np.int16(ov_cog_ijk[1]), np.int16(ov_cog_ijk[2])] = 1
-            dilated_cogOV = np.uint16(ndimage.morphology.binary_dilation(ov_Vox_COG_map, iterations=5))
-            dilated_cogOV[np.int16(ov_cog_ijk[0]), np.int16(ov_cog_ijk[1]), np.int16(ov_cog_ijk[2])] = 10
-
-            # Create array for all ov_voxels image (will need a for loop)
-            for qq in range(0,ov_xyz.shape[0]):
-                ov_Vox_map[np.int16(ov_ijk[qq][0]), np.int16(ov_ijk[qq][1]), np.int16(ov_ijk[qq][2])] = 1
-
-            nib.save(nib.Nifti1Image(np.uint16(ov_Vox_map), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dilated_cogOV), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_initial_overlapping_voxels_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_11), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_maskA_vox_mindist_2_overlap_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_22), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_A_COG.nii.gz')
-            nib.save(nib.Nifti1Image(np.uint16(dil_33), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_overlap_vox_mindist_2_mask_B_COG.nii.gz')
-
-            # calc percent overlap
-            ov_perc_mB = 100.0 * np.float32(np.count_nonzero(ov_ijk)) / np.float32(np.count_nonzero(im2_data))
-            ov_perc_mA = 100.0 * np.float32(np.count_nonzero(ov_ijk)) / np.float32(np.count_nonzero(im1_data))
-
-            print('Minimum distance between COG of overlapping voxels and all voxels of mask A = ', min_AvsOVCOG_d , 'mm')
-            print('Minimum distance between COG of mask A and all overlapping voxels = ', min_OV2ACOG_d , 'mm')
-            print('Minimum distance between COG of mask B and all overlapping voxels = ', min_OV2BCOG_d , 'mm')
-            print('Number of overlapping voxels between both masks: ', str(ov_count), ' voxels')
-            print('Percent volume overlap between masks relative to mask A = ', str(ov_perc_mA).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", ""), '%')
-            print('Percent volume overlap between masks relative to mask B = ', str(ov_perc_mB).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", ""), '%')
-
-
-            # need to propagate to results text file then append later results to it without overwriting
-            # also need to save overlap to nifti image ;)
-            with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
-                file_handler.write('Initial overlap found between both masks, distance calculations using overlapping voxels, their COG, as well as external outlines and COGs of both masks' + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of overlapping voxels and all voxels of mask A = ' + str(min_AvsOVCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                'Minimum distance between COG of mask A and all overlapping voxels = ' + str(min_OV2ACOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                'Minimum distance between COG of mask B and all overlapping voxels = ' + str(min_OV2BCOG_d).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + 'mm' + '\n' + \
-                '\n' + \
-                'Number of overlapping voxels between both masks: ' + str(ov_count) + ' voxels' + '\n' + \
-                'Percent volume overlap between masks relative to mask A = ' + str(ov_perc_mA) + '%' + '\n' + \
-                'Percent volume overlap between masks relative to mask B = ' + str(ov_perc_mB) + '%' + '\n' \
-                '\n')
-                file_handler.close()
-
-        elif wf == 2:
-            # print('No overlap found')
-            # need to propagate to results text file then append later results to it without overwriting
-            with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "w" ) as file_handler:
-                file_handler.write('No overlap found between both masks, distance calculations done using external outlines and COGs only' + '\n' + '\n')
-                file_handler.close()
-
-        # Save intermediate images to nii.gz in output dir
-        nib.save(nib.Nifti1Image(outline1, aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_edge.nii.gz')
-        nib.save(nib.Nifti1Image(outline2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_edge.nii.gz')
-
-        # needs a better cleanup strategy than simple morpho closure
-        # potential helpful option -> https://www.delftstack.com/howto/python/smooth-data-in-python/
-        # nib.save(nib.Nifti1Image(clean_im1, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_cleaned.nii.gz')
-        # nib.save(nib.Nifti1Image(clean_im2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_cleaned.nii.gz')
-        
-        nib.save(nib.Nifti1Image(im1_data, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A.nii.gz')
-        nib.save(nib.Nifti1Image(im2_data, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B.nii.gz')
-
-        nib.save(nib.Nifti1Image(eroded_im1, aff1), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_eroded.nii.gz')
-        nib.save(nib.Nifti1Image(eroded_im2, aff2), pwd +  '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_eroded.nii.gz')
-
-        # save output measures to a text file
-        with open(pwd + '/' + out_n + '_output/' +  out_n + '_output' + nm + '_output_measures.txt', "a+" ) as file_handler:
-            file_handler.write('Minimum distance between all voxels of mask A and mask B: ' + \
-                str(all_min) + 'mm \n' + \
-                'This is found between:- ' + '\n' + \
-                'Mask A voxel at voxel coordinates: ' + str(a_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask A voxel at mm coordinates: ' + str(a_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' \
-                'Mask B voxel at voxel coordinates: ' + str(b_vox_vv).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask B voxel at mm coordinates: ' + str(b_vox_mm).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask A and COG of mask B: ' + str(cogs_d) + 'mm \n' + \
-                'COG of mask A voxel coordinates: ' + str(cog1).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask A mm coordinates: ' + str(cog1_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask B voxel coordinates :' + str(cog2).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'COG of mask B mm coordinates: ' + str(cog2_xyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask A and all voxels of mask B: ' + str(coga_2b) + 'mm \n' + \
-                'Mask B voxel(s) with shortest distance to mask A COG voxel coordinates: ' + str(ca2bijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask B voxel(s) with shortest distance to mask A COG mm coordinates: ' + str(ca2bxyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                '\n' + \
-                'Minimum distance between COG of mask B and all voxels of mask A: ' + str(cogb_2a) + 'mm \n' + \
-                'Mask A voxel(s) with shortest distance to mask B COG voxel coordinates: ' + str(cb2aijk).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n' + \
-                'Mask A voxel(s) with shortest distance to mask B COG mm coordinates: ' + str(cb2axyz).replace("  ", " ").replace(" ", ", ").replace("[", "").replace("]", "") + '\n')
-                
-                
-        # save voxels of min distances to two different images
-        # save voxels of min distances to the same image or different images ??
-        vox_A_maps[np.int16(a_vox_vv[0][0]), np.int16(a_vox_vv[0][1]), np.int16(a_vox_vv[0][2])] = 1
-        COGA_map[np.int16(cog1[0]), np.int16(cog1[1]), np.int16(cog1[2])] = 1
-        vox_B_maps[np.int16(b_vox_vv[0][0]), np.int16(b_vox_vv[0][1]), np.int16(b_vox_vv[0][2])] = 1
-        COGB_map[np.int16(cog2[0]), np.int16(cog2[1]), np.int16(cog2[2])] = 1
-        dilated_A = np.uint16(ndimage.morphology.binary_dilation(vox_A_maps, iterations=5))
-        dilated_cogA = np.uint16(ndimage.morphology.binary_dilation(COGA_map, iterations=5))
-        dilated_B = np.uint16(ndimage.morphology.binary_dilation(vox_B_maps, iterations=5))
-        dilated_cogB = np.uint16(ndimage.morphology.binary_dilation(COGB_map, iterations=5))
-
-        dilated_A[np.int16(a_vox_vv[0][0]), np.int16(a_vox_vv[0][1]), np.int16(a_vox_vv[0][2])] = 10
-        dilated_B[np.int16(b_vox_vv[0][0]), np.int16(b_vox_vv[0][1]), np.int16(b_vox_vv[0][2])] = 10
-        dilated_cogA[np.int16(cog1[0]), np.int16(cog1[1]), np.int16(cog1[2])] = 10
-        dilated_cogB[np.int16(cog2[0]), np.int16(cog2[1]), np.int16(cog2[2])] = 10
-        
-        # save these voxel maps
-        nib.save(nib.Nifti1Image(np.uint16(dilated_A), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_vox_mindist_2_all_B_mask_vox.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_B), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_vox_mindist_2_all_A_mask_vox.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_cogA), aff1), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_A_COG.nii.gz')
-        nib.save(nib.Nifti1Image(np.uint16(dilated_cogB), aff2), pwd + '/' + out_n + '_output' + '/' + out_n + nm + '_mask_B_COG.nii.gz')
-
-    else:         
-        print('the affines of the inputs are not matching, please double check, exiting')
+    try:
+        res = edsB2masks(in1, in2, out, mode, max_mem, margin, formats, level=level, compress=compress, ncpu=ncpu)
+    except ValueError as e:
+        print(str(e) + ', please double check, exiting')
         exit()
+    printResult(res)
 
 
 if __name__ == "__main__":
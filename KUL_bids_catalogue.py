@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# SQLite catalogue of the images in a BIDS directory and their json sidecars
+#
+# One pass over the BIDS tree stores for every nifti: the path, subject, session, datatype, suffix, run,
+# the dimensions and voxel sizes from the nifti header (the image itself is not read) and all fields of its
+# json sidecar. Next time only images whose nifti or json mtime changed are read again, and images that are
+# gone are removed. The catalogue is kept in BIDS/.KUL_bids_catalogue.sqlite by default, with the paths relative
+# to the BIDS directory, so it does not matter how the BIDS directory is given (BIDS, ./BIDS or an absolute path).
+#
+# Use as a module:
+#   import KUL_bids_catalogue
+#   db = KUL_bids_catalogue.updateCatalogue('BIDS')
+#   for scan in KUL_bids_catalogue.scans(db, datatype='anat'):
+#       print(scan['path'], scan['zooms'], scan['sidecar'].get('SeriesNumber'))
+#
+# or from the command line, printing one line per image with the dimensions and the requested sidecar fields:
+#   KUL_bids_catalogue.py -b BIDS -f Manufacturer SeriesDescription EchoTime
+
+import os
+import re
+import sys
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+catalogue_name = '.KUL_bids_catalogue.sqlite'
+
+columns = ['path', 'directory', 'subject', 'session', 'datatype', 'suffix', 'run', 'nii_mtime', 'json_path', 'json_mtime',
+           'ndim', 'dims', 'zooms', 'sidecar']
+
+
+# a function to get the BIDS entities of an image from its path
+def entities(path):
+    name = os.path.basename(path).split('.')[0]
+    parts = name.split('_')
+    found = {'subject': None, 'session': None, 'run': None}
+    for part in parts[:-1]:
+        key, _, value = part.partition('-')
+        if key == 'sub':
+            found['subject'] = value
+        elif key == 'ses':
+            found['session'] = value
+        elif key == 'run':
+            found['run'] = value
+    found['suffix'] = parts[-1]
+    found['datatype'] = os.path.basename(os.path.dirname(path))
+    return found
+
+def sidecarPath(path):
+    return re.sub(r'\.nii(\.gz)?$', '', path) + '.json'
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# a function to read one image: its header and its json sidecar
+def readScan(bids_dir, rel):
+    path = os.path.join(bids_dir, rel)
+    row = {'path': rel, 'directory': os.path.dirname(rel), 'json_path': sidecarPath(rel)}
+    row.update(entities(rel))
+    row['nii_mtime'] = mtime(path)
+    row['json_mtime'] = mtime(os.path.join(bids_dir, row['json_path']))
+    try:
+        header = nib.load(path).header
+        shape = header.get_data_shape()
+        row['ndim'] = len(shape)
+        row['dims'] = json.dumps([int(d) for d in shape])
+        row['zooms'] = json.dumps([float(z) for z in header.get_zooms()])
+    except Exception as e:
+        print('Could not read the header of ' + path + ': ' + str(e), file=sys.stderr)
+        row['ndim'], row['dims'], row['zooms'] = None, None, None
+    sidecar = {}
+    if row['json_mtime'] is not None:
+        try:
+            with open(os.path.join(bids_dir, row['json_path'])) as f:
+                sidecar = json.load(f)
+        except (OSError, ValueError) as e:
+            print('Could not read ' + sidecarPath(path) + ': ' + str(e), file=sys.stderr)
+    row['sidecar'] = json.dumps(sidecar)
+    return row
+
+def openCatalogue(db_file):
+    db = sqlite3.connect(db_file)
+    db.row_factory = sqlite3.Row
+    db.execute('CREATE TABLE IF NOT EXISTS scans (path TEXT PRIMARY KEY, directory TEXT, subject TEXT, session TEXT, '
+               'datatype TEXT, suffix TEXT, run TEXT, nii_mtime REAL, json_path TEXT, json_mtime REAL, '
+               'ndim INTEGER, dims TEXT, zooms TEXT, sidecar TEXT)')
+    # catalogues made before the directory column are given one
+    if 'directory' not in [row['name'] for row in db.execute('PRAGMA table_info(scans)')]:
+        db.execute('ALTER TABLE scans ADD COLUMN directory TEXT')
+        db.executemany('UPDATE scans SET directory = ? WHERE path = ?',
+                       [[os.path.dirname(row['path']), row['path']] for row in db.execute('SELECT path FROM scans')])
+        db.commit()
+    db.execute('CREATE INDEX IF NOT EXISTS scans_type ON scans (datatype, suffix)')
+    db.execute('CREATE INDEX IF NOT EXISTS scans_directory ON scans (directory)')
+    # the BIDS directory as given the last time, the paths returned by scans are below it
+    db.execute('CREATE TABLE IF NOT EXISTS catalogue (bids_dir TEXT)')
+    return db
+
+def findImages(bids_dir):
+    # all nifti images below bids_dir, relative to it and sorted
+    # derivatives and sourcedata are included, like the find of KUL_bids_summary.sh and the os.walk of
+    # KUL_BIDS_clean.py did before, only hidden directories are skipped
+    images = []
+    for root, dirs, files in os.walk(bids_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if name.endswith('.nii.gz') or name.endswith('.nii'):
+                images.append(os.path.relpath(os.path.join(root, name), bids_dir))
+    return images
+
+def updateCatalogue(bids_dir='BIDS', db_file=None, ncpu=None, verbose=False):
+    # bring the catalogue of bids_dir up to date and return the open database
+    if db_file is None:
+        db_file = os.path.join(bids_dir, catalogue_name)
+    db = openCatalogue(db_file)
+    known = {row['path']: (row['nii_mtime'], row['json_mtime'])
+             for row in db.execute('SELECT path, nii_mtime, json_mtime FROM scans')}
+
+    images = findImages(bids_dir)
+    to_read = [rel for rel in images
+               if known.get(rel) != (mtime(os.path.join(bids_dir, rel)), mtime(os.path.join(bids_dir, sidecarPath(rel))))]
+    gone = set(known) - set(images)
+
+    if to_read:
+        if verbose:
+            print('Reading ' + str(len(to_read)) + ' of ' + str(len(images)) + ' images in ' + bids_dir, file=sys.stderr)
+        with ThreadPoolExecutor(max_workers=ncpu) as executor:
+            rows = list(executor.map(lambda rel: readScan(bids_dir, rel), to_read))
+        db.executemany('INSERT OR REPLACE INTO scans (' + ', '.join(columns) + ') VALUES (' +
+                       ', '.join('?' * len(columns)) + ')',
+                       [[row[c] for c in columns] for row in rows])
+    if gone:
+        db.executemany('DELETE FROM scans WHERE path = ?', [[rel] for rel in gone])
+    db.execute('DELETE FROM catalogue')
+    db.execute('INSERT INTO catalogue (bids_dir) VALUES (?)', [bids_dir])
+    db.commit()
+    return db
+
+def scans(db, datatype=None, suffix=None, directory=None):
+    # the images in the catalogue as dicts, with the paths below the BIDS directory and dims, zooms and sidecar parsed
+    bids_dir = db.execute('SELECT bids_dir FROM catalogue').fetchone()[0]
+    query = 'SELECT * FROM scans'
+    conditions, values = [], []
+    if datatype is not None:
+        conditions.append('datatype = ?')
+        values.append(datatype)
+    if suffix is not None:
+        conditions.append('suffix = ?')
+        values.append(suffix)
+    if directory is not None:
+        # the directory is given below the BIDS directory, as returned by directories
+        rel_dir = os.path.relpath(directory, bids_dir)
+        conditions.append('directory = ?')
+        values.append('' if rel_dir == '.' else rel_dir)
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    found = []
+    for row in db.execute(query + ' ORDER BY path', values):
+        scan = dict(row)
+        scan['path'] = os.path.join(bids_dir, scan['path'])
+        scan['json_path'] = os.path.join(bids_dir, scan['json_path'])
+        scan['directory'] = os.path.join(bids_dir, scan['directory'])
+        for key in ['dims', 'zooms', 'sidecar']:
+            scan[key] = json.loads(scan[key]) if scan[key] else None
+        found.append(scan)
+    return found
+
+def directories(db, datatype):
+    # the directories holding images of a datatype
+    bids_dir = db.execute('SELECT bids_dir FROM catalogue').fetchone()[0]
+    return [os.path.join(bids_dir, row['directory'])
+            for row in db.execute('SELECT DISTINCT directory FROM scans WHERE datatype = ? ORDER BY directory', [datatype])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the SQLite catalogue of a BIDS directory",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-b", "--bidsdir", default='BIDS', help="BIDS directory")
+    parser.add_argument("-d", "--database", help="catalogue file, default " + catalogue_name + " in the BIDS directory")
+    parser.add_argument("-f", "--fields", nargs='+', default=[],
+                        help="print path, ndim, dims and these sidecar fields for every image")
+    parser.add_argument("-s", "--separator", default='\t', help="separator of the printed fields")
+    parser.add_argument("-j", "--ncpu", type=int, default=os.cpu_count(), help="number of threads reading headers")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.bidsdir):
+        print(args.bidsdir + ' does not exist')
+        exit(1)
+
+    db = updateCatalogue(args.bidsdir, args.database, args.ncpu, args.verbose)
+    if args.fields:
+        for scan in scans(db):
+            dims = scan['dims'] or []
+            values = [scan['path'], str(scan['ndim'] or '')] + [str(d) for d in (dims + [''] * 4)[:4]]
+            for field in args.fields:
+                value = scan['sidecar'].get(field, '')
+                values.append(json.dumps(value) if isinstance(value, (list, dict)) else str(value))
+            print(args.separator.join(values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Creates a summary of information of the BIDS directory, like KUL_bids_summary.sh
+# Information gathered is:
+#  - subjects
+#  - sessions
+#  - available data (T1w, T2w, FLAIR, func, dwi) with their scanner and sequence parameters
+#
+# The images come from KUL_bids_catalogue.py: every json sidecar is parsed once and the dimensions are
+# read from the nifti header only, by a pool of workers, and next time only changed images are read again.
+# The output BIDS_info.tsv has the same columns as the one of KUL_bids_summary.sh, with optionally
+# the same table as parquet (needs pandas and pyarrow).
+#
+# e.g.
+#   KUL_bids_summary.py -b BIDS -o BIDS_info.tsv -p BIDS_info.parquet -j 8
+
+import os
+import json
+import argparse
+import KUL_bids_catalogue
+# pandas is only needed for the parquet output
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# the columns of BIDS_info.tsv and the sidecar field they come from
+header = ['MRI-scan', 'Subject', 'Session', 'Type', 'Scan', 'Site', 'Manufacturer', 'Model', 'Software', 'Coil',
+          'MagneticFieldStrength', 'SeriesDescription', 'SeriesNumber', 'AcquisitionType', 'TE', 'TR', 'TI',
+          'DIM', 'Dim_x', 'Dim_y', 'Dim_z', 'Dynamics', 'ETL']
+sidecar_fields = {'Site': 'StationName',
+                  'Manufacturer': 'Manufacturer',
+                  'Model': 'ManufacturersModelName',
+                  'Software': 'SoftwareVersions',
+                  'Coil': 'CoilString',
+                  'MagneticFieldStrength': 'MagneticFieldStrength',
+                  'SeriesDescription': 'SeriesDescription',
+                  'SeriesNumber': 'SeriesNumber',
+                  'AcquisitionType': 'MRAcquisitionType',
+                  'TE': 'EchoTime',
+                  'TR': 'RepetitionTime',
+                  'TI': 'InversionTime',
+                  'ETL': 'EchoTrainLength'}
+
+
+# a function to make the summary row of one image
+def summaryRow(scan, bids_dir):
+    mri = scan['path']
+    # subject, session and type are the directories below the BIDS directory, as in KUL_bids_summary.sh
+    parts = os.path.relpath(mri, bids_dir).split(os.sep)
+    row = {'MRI-scan': mri,
+           'Subject': parts[0],
+           'Session': parts[1] if len(parts) > 1 else None,
+           'Type': parts[2] if len(parts) > 2 else None,
+           'Scan': scan['suffix']}
+    for column, field in sidecar_fields.items():
+        value = scan['sidecar'].get(field)
+        row[column] = json.dumps(value) if isinstance(value, (list, dict)) else value
+    dims = scan['dims'] or []
+    row['DIM'] = scan['ndim']
+    for i, column in enumerate(['Dim_x', 'Dim_y', 'Dim_z', 'Dynamics']):
+        row[column] = dims[i] if i < len(dims) else None
+    return row
+
+# the columns are separated by ', ', a comma in a value (e.g. SeriesDescription "T1, 3D" or a list)
+# would add columns, so it is replaced by a semicolon
+def tsvValue(value):
+    return '' if value is None else str(value).replace(',', ';')
+
+# parquet needs one type per column, the sidecar fields can mix numbers and text over the images
+# (e.g. SeriesNumber 301 and "301"), such columns are written as text
+def parquetFrame(rows):
+    frame = pd.DataFrame(rows, columns=header)
+    for column in frame.columns:
+        values = frame[column].dropna()
+        numeric = values.map(lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)).all()
+        if not numeric:
+            frame[column] = frame[column].map(lambda v: None if v is None else str(v))
+    return frame
+
+
+parser = argparse.ArgumentParser(description="Summarise the images of a BIDS directory",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-b", "--bidsdir", default='BIDS', help="BIDS directory")
+parser.add_argument("-o", "--output", default='BIDS_info.tsv', help="summary table")
+parser.add_argument("-p", "--parquet", help="also write the summary table as parquet to this file")
+parser.add_argument("-j", "--ncpu", type=int, default=os.cpu_count(), help="number of workers reading the images")
+parser.add_argument("-v", "--verbose", action="store_true", help="print the summary of every image")
+args = parser.parse_args()
+
+if not os.path.isdir(args.bidsdir):
+    print(args.bidsdir + ' does not exist')
+    exit(1)
+if args.parquet and pd is None:
+    print('The parquet output needs pandas and pyarrow, please install them (pip install pandas pyarrow)')
+    exit(1)
+
+db = KUL_bids_catalogue.updateCatalogue(args.bidsdir, ncpu=args.ncpu, verbose=args.verbose)
+rows = [summaryRow(scan, args.bidsdir) for scan in KUL_bids_catalogue.scans(db)]
+print('Number of nifti data in the BIDS folder: ' + str(len(rows)))
+
+with open(args.output, 'w') as f:
+    f.write(', '.join(header) + '\n')
+    for row in rows:
+        if args.verbose:
+            for column in header:
+                print(column + ': ' + tsvValue(row[column]))
+        f.write(', '.join(tsvValue(row[column]) for column in header) + '\n')
+print('Summary written to ' + args.output)
+
+if args.parquet:
+    parquetFrame(rows).to_parquet(args.parquet, index=False)
+    print('Summary written to ' + args.parquet)
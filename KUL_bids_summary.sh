@@ -6,7 +6,7 @@
 #  - sessions
 #  - available data (T1w, T2w, FLAIR, func, dwi)
 #
-# Requires Mrtrix3
+# Requires python with nibabel (KUL_bids_catalogue.py)
 #
 # @ Stefan Sunaert - UZ/KUL - stefan.sunaert@uzleuven.be
 #
@@ -28,85 +28,54 @@ cwd=$(pwd)
 bids_dir=BIDS
 output=BIDS_info.tsv
 
-# find all images in the bids directory
-search_mri=($(find ${bids_dir} -type f | grep nii.gz | sort))
-num_mri=${#search_mri[@]}
+# one pass over the bids directory with KUL_bids_catalogue.py, only changed images and sidecars are read again
+# every line holds the image, its dimensions and the sidecar fields, separated by |
+fields="StationName Manufacturer ManufacturersModelName SoftwareVersions CoilString MagneticFieldStrength \
+    SeriesDescription SeriesNumber MRAcquisitionType EchoTime RepetitionTime InversionTime EchoTrainLength"
+catalogue=$(python ${kul_main_dir}/KUL_bids_catalogue.py -b ${bids_dir} -s '|' -f $fields)
+num_mri=$(echo -n "$catalogue" | grep -c '^')
 
 echo "Number of nifti data in the BIDS folder: $num_mri"
-#echo ${search_mri[@]}
 
 echo -e "MRI-scan, Subject, Session, Type, Scan, Site, Manufacturer, Model, Software, Coil, MagneticFieldStrength, SeriesDescription, SeriesNumber, AcquisitionType, TE, TR, TI, DIM, Dim_x, Dim_y, Dim_z, Dynamics, ETL" > $output 
 
-for i in `seq 0 $(($num_mri-1))`; do
+# without images the here-string still gives one empty line, so only read it if there are images
+if [ $num_mri -gt 0 ]; then
+    while IFS='|' read -r mri dim dim_x dim_y dim_z dynamics site manufacturer model soft coil \
+        MagneticFieldStrength SeriesDescription SeriesNumber AcquisitionType TE TR TI ETL; do
     
-    mri=${search_mri[$i]}
-    echo "MRI-scan: $mri"
-
-    sub=$(echo $mri | cut -d/ -f2)
-    echo "Subject: $sub"
-
-    ses=$(echo $mri | cut -d/ -f3)
-    echo "Session: $ses"
-
-    type=$(echo $mri | cut -d/ -f4)
-    echo "Type: $type"
-
-    scan=$(echo $mri | awk -F_ '{print $NF}' | cut -d. -f 1)
-    echo "Scan: $scan"
-
-    json=${mri%%.*}.json
-    #echo $json
-
-    site=$(grep StationName  $json | cut -d: -f2 | cut -d, -f 1)
-    echo "Site: $site"
-
-    manufacturer=$(grep \"Manufacturer\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "Manufacturer: $manufacturer"
-
-    model=$(grep \"ManufacturersModelName\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "Model: $model"
-    
-    soft=$(grep \"SoftwareVersions\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "Software: $soft"
-
-    coil=$(grep \"CoilString\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "Coil: $coil"
-
-    MagneticFieldStrength=$(grep \"MagneticFieldStrength\"  $json | cut -d: -f2 | cut -d, -f 1)
-    echo "MagneticFieldStrength: $MagneticFieldStrength"
-
-    SeriesDescription=$(grep \"SeriesDescription\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "SeriesDescription: $SeriesDescription"
-
-    SeriesNumber=$(grep \"SeriesNumber\"  $json | cut -d: -f2 | cut -d, -f 1)
-    echo "SeriesNumber: $SeriesNumber"
-
-    AcquisitionType=$(grep \"MRAcquisitionType\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "AcquisitionType: $AcquisitionType"
-
-    TE=$(grep EchoTime  $json | cut -d: -f2 | cut -d, -f 1)
-    echo "TE: $TE"
-
-    TR=$(grep -w RepetitionTime  $json | cut -d: -f2 | cut -d, -f 1)
-    echo "TR: $TR"
-
-    TI=$(grep \"InversionTime\"  $json | cut -d: -f2 | cut -d, -f 1 | tr -d '"')
-    echo "InversionTime: $TI"
-
-    dim=$(mrinfo $mri -ndim)
-    echo "Dimensions: $dim"
-
-    dim_x=$(mrinfo $mri -size | cut -d" " -f 1)
-    dim_y=$(mrinfo $mri -size | cut -d" " -f 2)
-    dim_z=$(mrinfo $mri -size | cut -d" " -f 3)
-    dynamics=$(mrinfo $mri -size | cut -d" " -f 4)
-
-    ETL=$(grep EchoTrainLength $json | cut -d: -f2 | cut -d, -f 1)
-    echo "ETL: $ETL"
-
-    echo -e "$mri, $sub, $ses, $type, $scan, $site, $manufacturer \
+        echo "MRI-scan: $mri"
+
+        sub=$(echo $mri | cut -d/ -f2)
+        echo "Subject: $sub"
+
+        ses=$(echo $mri | cut -d/ -f3)
+        echo "Session: $ses"
+
+        type=$(echo $mri | cut -d/ -f4)
+        echo "Type: $type"
+
+        scan=$(echo $mri | awk -F_ '{print $NF}' | cut -d. -f 1)
+        echo "Scan: $scan"
+
+        echo "Site: $site"
+        echo "Manufacturer: $manufacturer"
+        echo "Model: $model"
+        echo "Software: $soft"
+        echo "Coil: $coil"
+        echo "MagneticFieldStrength: $MagneticFieldStrength"
+        echo "SeriesDescription: $SeriesDescription"
+        echo "SeriesNumber: $SeriesNumber"
+        echo "AcquisitionType: $AcquisitionType"
+        echo "TE: $TE"
+        echo "TR: $TR"
+        echo "InversionTime: $TI"
+        echo "Dimensions: $dim"
+        echo "ETL: $ETL"
+
+        echo -e "$mri, $sub, $ses, $type, $scan, $site, $manufacturer \
        , $model, $soft, $coil, $MagneticFieldStrength, $SeriesDescription, $SeriesNumber \
        , $AcquisitionType, $TE, $TR, $TI, $dim, $dim_x, $dim_y, $dim_z, $dynamics, $ETL" >> $output 
 
-done
-
+    done <<< "$catalogue"
+fi
@@ -3,20 +3,55 @@
 # Stefan Sunaert - 17/05/2023
 
 import os
+import json
+import shlex
+import hashlib
+import struct
+import shutil
+import tempfile
 import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+# pydicom reads all tags in one pass, without it every tag is read by a dcminfo call
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+# numpy and nibabel are needed for the native conversion of anatomical series, without them mrconvert is used
+try:
+    import numpy as np
+    import nibabel as nib
+except ImportError:
+    nib = None
+# the persistent dicom index (needs pydicom), without it mrinfo selects the series
+try:
+    import KUL_dcm_index
+except ImportError:
+    KUL_dcm_index = None
 
 # Get commandline
 parser = argparse.ArgumentParser(description="Convert dicom to nifti",
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--participant', help='participant id', required=True)
 parser.add_argument('--dicomdir', help='dicom input directory', required=True)
-parser.add_argument('--seriesnumbers', nargs='+', help='series numbers', required=True)
+parser.add_argument('--seriesnumbers', nargs='+', required=True,
+                    help='series numbers, only the first is converted unless several --type or -a values are given')
 parser.add_argument('--type', nargs='+', help='type, e.g T1w, dwi, func', required=True)
 parser.add_argument('--donor_dcm', nargs='+', help='the donor dicom used to extract tags, e.g. IM-001.dcm', required=True)
 parser.add_argument('-i', '--inputtype', nargs='+', help='inputtype, e.g. M_FFE')
 parser.add_argument('-o', '--outputtype', nargs='+', help='outputtype, e.g. phase')
 parser.add_argument('-a', '--acquisition', nargs='+', help='acquisition, e.g. ap')
 parser.add_argument('-e', '--pe_direction', nargs='+', help='phase encoding direction, e.g. j-')
+parser.add_argument('-j', '--ncpu', type=int, default=4, help='number of conversions run at the same time')
+parser.add_argument('-l', '--logdir', help='directory for a log file per conversion')
+parser.add_argument('--index', help='dicom index file, default .KUL_dcm_index_sub-<participant>.json in the log directory, '
+                                    'or in the output directory without one')
+parser.add_argument('-f', '--force', action='store_true', help='convert again, also if the outputs are up to date')
+parser.add_argument('-n', '--native', action='store_true',
+                    help='convert plain 3d anatomical series natively (pydicom and nibabel) instead of with mrconvert, '
+                         'their json sidecar only holds the donor tags, TE, TR, TI and the flip angle')
+parser.add_argument('-m', '--mrconvert', action='store_true',
+                    help='always use mrconvert (the default), also if --native is given')
 
 args = parser.parse_args()
 
@@ -43,12 +78,45 @@ print(nii_parts)
 # tags to get from donor
 # a function to get tags
 def getDicomTag(tag):
-    cmd = 'dcminfo -tag ' + tag + ' ' + '\"' + donor_dcm[0] +'\"'
+    cmd = 'dcminfo -tag ' + tag + ' ' + shlex.quote(donor_dcm[0])
     #print(cmd)
     out = os.popen(cmd).read().strip()
     #print(out)
     return out.split(' ')[1]
 
+# Philips private tags are stored as bytes when the donor is implicit VR, their struct format
+private_formats = {'2001 1022': '<f',  # WaterFatShift, FL
+                   '2001 1013': '<l'}  # EPIFactor, SL
+
+# a function to get all tags in one read of the header, without the pixel data
+# returns None if pydicom is not available or the file can not be read
+def readDicomTags(dcm_file, tags):
+    if pydicom is None:
+        return None
+    tag_numbers = {key: pydicom.tag.Tag(int(tags[key][:4], 16), int(tags[key][5:], 16)) for key in tags}
+    try:
+        ds = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=list(tag_numbers.values()))
+    except Exception as e:
+        print('pydicom could not read ' + dcm_file + ': ' + str(e))
+        return None
+
+    values = {}
+    for key, tag in tag_numbers.items():
+        if tag not in ds:
+            print(key + ' (' + tags[key] + ') not found in ' + dcm_file)
+            continue
+        value = ds[tag].value
+        if isinstance(value, bytes):
+            if tags[key] in private_formats:
+                fmt = private_formats[tags[key]]
+                value = struct.unpack(fmt, value[:struct.calcsize(fmt)])[0]
+            else:
+                value = value.decode('latin-1').strip(' \0')
+        elif isinstance(value, pydicom.multival.MultiValue):
+            value = '\\'.join(str(v) for v in value)
+        values[key] = str(value).strip()
+    return values
+
 # define tags to read from the donor dcm
 dict_tags = {'Modality': '0008 0060', \
         'MagneticFieldStrength': '0018 0087', \
@@ -69,41 +137,44 @@ dict_tags = {'Modality': '0008 0060', \
         'EPIFactor': '2001 1013', \
         'Rows': '0028 0010'}
 
-# get the relevant tags
-dict_dcm = {}
-for key in dict_tags:
-    print(key)
-    print(dict_tags[key])
-    dict_tags[key] = getDicomTag(dict_tags[key])
-    #print(dict_tags[key])
-    dict_dcm.update({key : dict_tags[key]})
+# get the relevant tags, all at once with pydicom or one by one with dcminfo
+dict_dcm = readDicomTags(donor_dcm[0], dict_tags)
+if dict_dcm is None:
+    dict_dcm = {}
+    for key in dict_tags:
+        print(key)
+        print(dict_tags[key])
+        dict_dcm.update({key : getDicomTag(dict_tags[key])})
 #print(dict_dcm)
 
 # calculate 
 #ActualEchoSpacing = WaterFatShift / (ImagingFrequency * 3.4 * (EPI_Factor + 1))
 #TotalReadoutTIme = ActualEchoSpacing * EPI_Factor
 # EffectiveEchoSpacing = TotalReadoutTime / (ReconMatrixPE - 1)
-ActualEchoSpacing = float(dict_dcm['WaterFatShift']) \
-    / (float(dict_dcm['ImagingFrequency']) * 3.4 * (float(dict_dcm['EPIFactor']) + 1))
-TotalReadoutTime = ActualEchoSpacing * float(dict_dcm['EPIFactor'])
-EffectiveEchoSpacing = TotalReadoutTime / (float(dict_dcm['Rows']) - 1 )
+if all(key in dict_dcm for key in ['WaterFatShift', 'ImagingFrequency', 'EPIFactor', 'Rows']):
+    ActualEchoSpacing = float(dict_dcm['WaterFatShift']) \
+        / (float(dict_dcm['ImagingFrequency']) * 3.4 * (float(dict_dcm['EPIFactor']) + 1))
+    TotalReadoutTime = ActualEchoSpacing * float(dict_dcm['EPIFactor'])
+    EffectiveEchoSpacing = TotalReadoutTime / (float(dict_dcm['Rows']) - 1 )
 
-'''
-print(ActualEchoSpacing)
-print(TotalReadoutTime)
-print(EffectiveEchoSpacing)
-'''
+    '''
+    print(ActualEchoSpacing)
+    print(TotalReadoutTime)
+    print(EffectiveEchoSpacing)
+    '''
 
-# insert into dict
-dict_dcm.update({'TotalReadoutTime': TotalReadoutTime})
-dict_dcm.update({'EffectiveEchoSpacing': EffectiveEchoSpacing})
+    # insert into dict
+    dict_dcm.update({'TotalReadoutTime': TotalReadoutTime})
+    dict_dcm.update({'EffectiveEchoSpacing': EffectiveEchoSpacing})
+else:
+    print('Not all tags for the echo spacing were found, TotalReadoutTime and EffectiveEchoSpacing are not set')
 print(dict_dcm)
 
 # make the addition properties to insert to the mif or nii
 additional_properties = ''
 for key in dict_dcm:
     print(key)
-    additional_properties = additional_properties + '-set_property ' + key + ' ' + str(dict_dcm[key]) + ' '
+    additional_properties = additional_properties + '-set_property ' + key + ' ' + shlex.quote(str(dict_dcm[key])) + ' '
 print(additional_properties)
 
 
@@ -123,32 +194,189 @@ nii_dir = '.'
 if not os.path.exists(nii_dir):
    os.makedirs(nii_dir)
 
-#for i, dcm_serie in enumerate(dcm_series):
-i = 0
-dcm_serie = dcm_series
-#print(i)
-for j, nii_part in enumerate(nii_parts):
-    #j = 0
-    #nii_part = nii_parts[0]
-    #print(j)
-    print(bids_type[i])
-    if bids_type[i] == 'dwi':
-        part = '_part-' + str(nii_part)
+# index the dicom directory once, later runs only read new or changed files
+# the index is kept with the logs or the outputs, never in the (possibly read-only) dicom directory
+if KUL_dcm_index:
+    dcm_index_file = args.index or os.path.join(args.logdir or nii_dir, '.KUL_dcm_index_sub-' + participant + '.json')
+    if args.logdir:
+        os.makedirs(args.logdir, exist_ok=True)
+    dcm_index = KUL_dcm_index.buildIndex(dcm_dir, dcm_index_file)
+else:
+    dcm_index = None
+
+# a function to get the files of one series (and image type) from the index
+# returns None if there is no index or the series is not found in it
+def seriesFiles(seriesnumber, imagetype):
+    if dcm_index is None:
+        return None
+    try:
+        files = KUL_dcm_index.findFiles(dcm_index, seriesnumber=int(seriesnumber), imagetype=imagetype)
+    except ValueError:
+        return None
+    if not files:
+        print('Series ' + str(seriesnumber) + ' ' + str(imagetype or '') + ' not found in the dicom index')
+        return None
+    return files
+
+# a function to put links to files in a temporary directory
+def linkFiles(files):
+    link_dir = tempfile.mkdtemp(prefix='KUL_dcm2bids_')
+    for n, f in enumerate(files):
+        os.symlink(os.path.abspath(f), os.path.join(link_dir, str(n).rjust(6, '0') + '.dcm'))
+    return link_dir
+
+# the manifest next to the outputs records for every converted nifti a fingerprint of its inputs
+# (the dicom files, the donor tags and the options) and the size, mtime and hash of its outputs,
+# conversions with the same fingerprint and unchanged outputs are skipped
+manifest_file = os.path.join(nii_dir, '.KUL_dcm2bids_manifest.json')
+
+def loadManifest():
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def saveManifest(manifest):
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def dirFingerprint(path):
+    # without the index: names, sizes and mtimes of all files in the dicom directory
+    items = []
+    for root, dirs, names in os.walk(path, followlinks=True):
+        for name in names:
+            st = os.stat(os.path.join(root, name))
+            items.append((os.path.relpath(os.path.join(root, name), path), st.st_size, st.st_mtime))
+    return hashlib.sha256(json.dumps(sorted(items)).encode()).hexdigest()
+
+def outputRecord(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': fileHash(path)}
+
+def upToDate(entry, fingerprint):
+    # the fingerprint matches and every output still exists unchanged (by size and mtime, or else by hash)
+    if not entry or entry['fingerprint'] != fingerprint:
+        return False
+    for path, record in entry['outputs'].items():
+        if not os.path.exists(path):
+            return False
+        st = os.stat(path)
+        if st.st_size != record['size']:
+            return False
+        if st.st_mtime != record['mtime'] and fileHash(path) != record['sha256']:
+            return False
+    return True
+
+# the bids types of plain 3d anatomical series, with --native these are converted natively (pydicom and nibabel),
+# other types (dwi, func, ...) and series that are not a simple stack of single-frame slices go through mrconvert
+native_types = ['T1w', 'cT1w', 'T2w', 'FLAIR', 'FGATIR']
+
+# acquisition parameters added to the json sidecar of a native conversion, in seconds and degrees like mrconvert
+# this is not all the mrconvert -json_export sidecar holds (the other dicom header fields mrtrix reads,
+# its version and command history), so mrconvert stays the default and the native conversion is opt-in (--native)
+native_json_tags = {'EchoTime': 0.001, 'RepetitionTime': 0.001, 'InversionTime': 0.001, 'FlipAngle': 1}
+
+# a function to convert a 3d anatomical series to nifti and json
+# returns a message why it can not, then mrconvert is used
+def nativeConvert(files, nii_nii, nii_json):
+    slices = [pydicom.dcmread(f) for f in files]
+    first = slices[0]
+    for ds in slices:
+        if int(ds.get('NumberOfFrames', 1) or 1) > 1:
+            return 'multi-frame dicom'
+        if int(ds.get('SamplesPerPixel', 1)) != 1:
+            return 'not a grey scale image'
+        for key in ['Rows', 'Columns', 'ImageOrientationPatient', 'PixelSpacing']:
+            if key not in ds or ds.get(key) != first.get(key):
+                return 'the slices differ in ' + key
+        if 'ImagePositionPatient' not in ds:
+            return 'no ImagePositionPatient'
+    if len(slices) < 2:
+        return 'a single slice'
+
+    # sort the slices along the normal on the slices
+    iop = np.array(first.ImageOrientationPatient, dtype=float)
+    row_cos, col_cos = iop[:3], iop[3:]
+    normal = np.cross(row_cos, col_cos)
+    slices.sort(key=lambda ds: np.dot(normal, np.array(ds.ImagePositionPatient, dtype=float)))
+    ipp = np.array([ds.ImagePositionPatient for ds in slices], dtype=float)
+    steps = np.linalg.norm(np.diff(ipp, axis=0), axis=1)
+    if steps.min() < 1e-3:
+        return 'several slices at the same position (echoes, dynamics)'
+    if steps.max() - steps.min() > 1e-2 * steps.mean():
+        return 'unequal slice spacing'
+    slopes = set((float(ds.get('RescaleSlope', 1)), float(ds.get('RescaleIntercept', 0))) for ds in slices)
+    if len(slopes) > 1:
+        return 'the slices have different rescale slopes'
+
+    # voxel i runs along the rows (columns of the pixel data), j along the columns, k over the slices
+    try:
+        data = np.stack([ds.pixel_array.T for ds in slices], axis=2)
+    except Exception as e:
+        return 'the pixel data can not be decoded (' + str(e) + ')'
+    pixel_spacing = np.array(first.PixelSpacing, dtype=float)
+    affine = np.eye(4)
+    affine[:3, 0] = row_cos * pixel_spacing[1]
+    affine[:3, 1] = col_cos * pixel_spacing[0]
+    affine[:3, 2] = (ipp[-1] - ipp[0]) / (len(slices) - 1)
+    affine[:3, 3] = ipp[0]
+    # dicom is LPS, nifti RAS
+    affine = np.diag([-1, -1, 1, 1]) @ affine
+
+    img = nib.Nifti1Image(data, affine)
+    img.header.set_qform(affine, code=1)
+    img.header.set_sform(affine, code=1)
+    img.header.set_xyzt_units('mm', 'sec')
+    slope, intercept = slopes.pop()
+    if slope != 1 or intercept != 0:
+        img.header.set_slope_inter(slope, intercept)
+    nib.save(img, nii_nii)
+
+    sidecar = dict(dict_dcm)
+    for key, factor in native_json_tags.items():
+        if first.get(key) not in [None, '']:
+            sidecar[key] = float(first.get(key)) * factor
+    with open(nii_json, 'w') as f:
+        json.dump(sidecar, f, indent=4)
+    return None
+
+# a value per series, or the first one if only one was given
+def perSeries(values, i):
+    return values[i] if i < len(values) else values[0]
+
+# a function to make the output name of one series (i) and output part (j)
+def partName(i, j):
+    if perSeries(bids_type, i) == 'dwi':
+        part = '_part-' + str(nii_parts[j])
     else:
         part = ''
 
     if args.pe_direction:
-        pe = '_acq-' + dcm_pe[i]
+        pe = '_acq-' + perSeries(dcm_pe, i)
     else:
         pe = ''
-    nii_file = 'sub-' + participant + pe + part + '_' + str(bids_type[i])
+    return 'sub-' + participant + pe + part + '_' + str(perSeries(bids_type, i))
+
+# a function to make the mrconvert command of one series (i) and output part (j)
+def partCommand(i, j):
+    dcm_serie = dcm_series[i]
+    nii_file = partName(i, j)
     nii_nii = os.path.join(nii_dir,nii_file) + '.nii.gz'
     nii_json = os.path.join(nii_dir,nii_file) + '.json'
-    if bids_type[i] == 'dwi':
+    if perSeries(bids_type, i) == 'dwi':
         nii_bval = os.path.join(nii_dir,nii_file) + '.bval'
         nii_bvec = os.path.join(nii_dir,nii_file) + '.bvec'
         export_grad_fls = " -export_grad_fsl " + nii_bvec + " " + nii_bval 
-        property_pe = " -set_property \"PhaseEncodingDirection\" \"" + str(nii_pe[i]) + "\" "
+        property_pe = " -set_property \"PhaseEncodingDirection\" \"" + str(perSeries(nii_pe, i)) + "\" "
     else:
         export_grad_fls = ""
         property_pe = ""
@@ -159,15 +387,117 @@ for j, nii_part in enumerate(nii_parts):
     else:
         search_type = ""
 
-    cmd = "echo q | mrinfo \"" + str(dcm_dir) + "\" 2>&1 | grep " + str(dcm_serie[0]) + \
-        search_type + " | awk '{print $1}' | mrconvert " + \
-        " \"" + str(dcm_dir) + "\" " +  \
+    # with the index, mrconvert only reads the files of this series (and type),
+    # they are linked in a temporary directory that replaces {series_dir} when the conversion runs
+    files = seriesFiles(dcm_serie, dcm_types[j] if dcm_types else None)
+    if files:
+        select = "mrconvert \"{series_dir}\" "
+        inputs = KUL_dcm_index.fingerprint(dcm_index, files)
+    else:
+        inputs = dir_fingerprint
+        select = "echo q | mrinfo \"" + str(dcm_dir) + "\" 2>&1 | grep " + str(dcm_serie) + \
+            search_type + " | awk '{print $1}' | mrconvert " + \
+            " \"" + str(dcm_dir) + "\" "
+
+    options = select + \
         additional_properties + ' ' + \
         " -json_export " + nii_json + ' ' + \
         export_grad_fls + ' ' + \
-        property_pe + ' ' + \
+        property_pe + ' '
+    cmd = options + \
+        nii_threads + ' ' + \
         nii_nii + ' -force'
-    print(cmd)
-    #exit()
-    out = os.popen(cmd).read().strip()
-    print(out)
+
+    outputs = [nii_nii, nii_json]
+    if perSeries(bids_type, i) == 'dwi':
+        outputs += [nii_bval, nii_bvec]
+    native = bool(files) and perSeries(bids_type, i) in native_types and nib is not None and args.native and not args.mrconvert
+    fingerprint = hashlib.sha256(json.dumps([inputs, dict_dcm, options, nii_nii, native], sort_keys=True).encode()).hexdigest()
+    return nii_file, cmd, files, outputs, fingerprint, native, (nii_nii, nii_json)
+
+# a function to run one conversion, its output is kept together and written to its own log
+def convertPart(job):
+    i, j = job
+    nii_file, cmd, files, outputs, fingerprint, native, native_outputs = partCommand(i, j)
+    if not args.force and upToDate(manifest.get(nii_file), fingerprint):
+        return nii_file, 'skipped, up to date', 'not converted again', 0, None
+
+    if native:
+        try:
+            reason = nativeConvert(files, *native_outputs)
+        except Exception as e:
+            reason = str(e)
+        if reason is None:
+            entry = {'fingerprint': fingerprint, 'outputs': {o: outputRecord(o) for o in outputs}}
+            return nii_file, 'native conversion of ' + str(len(files)) + ' dicoms', 'done', 0, entry
+        print(nii_file + ': no native conversion, ' + reason + ', using mrconvert')
+
+    link_dir = linkFiles(files) if files else None
+    if link_dir:
+        cmd = cmd.replace('{series_dir}', link_dir)
+    try:
+        result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    finally:
+        if link_dir:
+            shutil.rmtree(link_dir)
+    out = result.stdout.strip()
+    if args.logdir:
+        with open(os.path.join(args.logdir, nii_file + '_mrconvert.log'), 'w') as f:
+            f.write(cmd + '\n' + out + '\n')
+    entry = None
+    if result.returncode == 0 and all(os.path.exists(o) for o in outputs):
+        entry = {'fingerprint': fingerprint, 'outputs': {o: outputRecord(o) for o in outputs}}
+    return nii_file, cmd, out, result.returncode, entry
+
+
+# as before, only the first series is converted, unless a --type or -a acquisition is given per series
+if len(bids_type) > 1 or (args.acquisition and len(dcm_pe) > 1):
+    convert_series = list(range(len(dcm_series)))
+else:
+    convert_series = [0]
+    if len(dcm_series) > 1:
+        print('Only series ' + dcm_series[0] + ' is converted, give a --type or -a acquisition per series to convert '
+              + ', '.join(dcm_series))
+
+# all series and parts are converted at the same time, by ncpu conversions
+# the threads of mrconvert are shared out over the conversions
+# two conversions with the same output name would write the same nifti, json and manifest entry at the same time:
+# the parts of a series that are not dwi all have the same name, of those only the last one is kept,
+# the one that overwrote the others when they were converted one after the other
+# different series with the same name can not be told apart and stop the conversion
+jobs = {}
+for i in convert_series:
+    for j in range(len(nii_parts)):
+        name = partName(i, j)
+        if name in jobs and jobs[name][0] != i:
+            print('Series ' + dcm_series[jobs[name][0]] + ' and ' + dcm_series[i] + ' would both be converted to ' + name
+                  + ', give each series its own --type or -a acquisition')
+            exit(1)
+        jobs[name] = (i, j)
+jobs = list(jobs.values())
+n_workers = max(1, min(args.ncpu, len(jobs)))
+if n_workers > 1:
+    nii_threads = '-nthreads ' + str(max(1, os.cpu_count() // n_workers))
+else:
+    nii_threads = ''
+if args.logdir:
+    os.makedirs(args.logdir, exist_ok=True)
+manifest = loadManifest()
+dir_fingerprint = dirFingerprint(dcm_dir) if dcm_index is None else None
+
+failed = []
+with ThreadPoolExecutor(max_workers=n_workers) as executor:
+    for nii_file, cmd, out, returncode, entry in executor.map(convertPart, jobs):
+        print(nii_file)
+        print(cmd)
+        print(out)
+        if returncode != 0:
+            failed.append(nii_file)
+            manifest.pop(nii_file, None)
+        elif entry:
+            manifest[nii_file] = entry
+saveManifest(manifest)
+
+if failed:
+    print('The conversion of ' + ', '.join(failed) + ' failed')
+    exit(1)
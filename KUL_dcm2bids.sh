@@ -886,6 +886,18 @@ else
 fi
 
 # Do the bruce force extract
+# the persistent dicom index (KUL_dcm_index.py, needs pydicom) reads each header once and writes the same dump,
+# fall back to one dcminfo per file if it is not available
+dcm_index_file=${log_dir}/${subj}_${sess}_dicom_index.json
+dcm_index_log=${log_dir}/${subj}_${sess}_dicom_index.log
+if python ${kul_main_dir}/KUL_dcm_index.py -i $dcm_index_file --dump ${tmp} > $dump_file 2> $dcm_index_log; then
+
+    kul_e2cl "    used the dicom index $dcm_index_file" $log
+
+else
+
+kul_e2cl "    the dicom index could not be used (see $dcm_index_log), reading the tags with dcminfo instead" $log
+
 echo hello > $dump_file
 
 task(){
@@ -900,6 +912,8 @@ while IFS= read -r dcm_file; do
 done
 )
 
+fi
+
 kul_e2cl "    done reading dicom tags of $dcm" $log
 
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# Convert the dicoms of a whole cohort with KUL_dcm2bids.py, several participants at the same time
+#
+# The participants are read from a study config csv (comma, semicolon or tab separated), by default
+# study_config/subjects_and_options.csv, from the column BIDS_participant.
+# The options of KUL_dcm2bids.py are taken from a column with the same name if the config has one
+# (dicomdir, seriesnumbers, type, donor_dcm, inputtype, outputtype, acquisition, pe_direction;
+# several values separated by spaces), otherwise from the command line, where {participant} is
+# replaced by the participant id, e.g.
+#
+#   KUL_dcm2bids_cohort.py -c study_config/subjects_and_options.csv \
+#       --dicomdir 'DICOM/{participant}' --donor_dcm 'DICOM/{participant}/IM-0001.dcm' \
+#       --seriesnumbers 401 --type dwi -i M_SE PHASE -o mag phase -a ap -e j- -j 8
+#
+# Every participant is converted in its own directory (-d, default BIDS/sub-{participant})
+# with its own log, failed participants are tried again (-r), and the time per participant is reported.
+
+import os
+import sys
+import csv
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# the options that are passed on to KUL_dcm2bids.py
+dcm2bids_options = ['dicomdir', 'seriesnumbers', 'type', 'donor_dcm',
+                    'inputtype', 'outputtype', 'acquisition', 'pe_direction']
+
+# Get commandline
+parser = argparse.ArgumentParser(description="Convert dicom to nifti for all participants of a study config",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-c', '--config', default='study_config/subjects_and_options.csv', help='study config csv')
+parser.add_argument('-d', '--outdir', default='BIDS/sub-{participant}', help='output directory per participant')
+parser.add_argument('--dicomdir', help='dicom input directory')
+parser.add_argument('--seriesnumbers', nargs='+', help='series numbers')
+parser.add_argument('--type', nargs='+', help='type, e.g T1w, dwi, func')
+parser.add_argument('--donor_dcm', nargs='+', help='the donor dicom used to extract tags, e.g. IM-001.dcm')
+parser.add_argument('-i', '--inputtype', nargs='+', help='inputtype, e.g. M_FFE')
+parser.add_argument('-o', '--outputtype', nargs='+', help='outputtype, e.g. phase')
+parser.add_argument('-a', '--acquisition', nargs='+', help='acquisition, e.g. ap')
+parser.add_argument('-e', '--pe_direction', nargs='+', help='phase encoding direction, e.g. j-')
+parser.add_argument('-j', '--ncpu', type=int, default=4, help='number of participants converted at the same time')
+parser.add_argument('-p', '--part_ncpu', type=int, default=1, help='number of conversions per participant at the same time')
+parser.add_argument('-r', '--retries', type=int, default=1, help='number of times a failed participant is tried again')
+parser.add_argument('-l', '--logdir', default='KUL_LOG/dcm2bids_cohort', help='directory for the logs')
+parser.add_argument('-s', '--participants', nargs='+', help='only convert these participants')
+
+args = parser.parse_args()
+
+dcm2bids = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'KUL_dcm2bids.py')
+
+
+# a function to read the participants of the study config, with their own options if present
+def readConfig(config_file):
+    with open(config_file, newline='') as f:
+        text = f.read()
+    dialect = csv.Sniffer().sniff(text.splitlines()[0], delimiters=',;\t')
+    rows = csv.DictReader(text.splitlines(), dialect=dialect)
+    participants = []
+    for row in rows:
+        row = {k.strip(): (v or '').strip() for k, v in row.items() if k}
+        participant = row.get('BIDS_participant', '')
+        if not participant or participant.startswith('#'):
+            continue
+        participants.append(row)
+    return participants
+
+# a function to make the KUL_dcm2bids.py command of one participant
+def participantCommand(row):
+    participant = row['BIDS_participant']
+    cmd = [sys.executable, dcm2bids, '--participant', participant, '-j', str(args.part_ncpu)]
+    for option in dcm2bids_options:
+        if row.get(option) and row[option] != 'NA':
+            values = row[option].split()
+        elif getattr(args, option):
+            value = getattr(args, option)
+            values = value if isinstance(value, list) else [value]
+        else:
+            continue
+        cmd += ['--' + option] + [v.replace('{participant}', participant) for v in values]
+    return cmd
+
+# a function to convert one participant, returns the participant, success, attempts and seconds
+def convertParticipant(row):
+    participant = row['BIDS_participant']
+    cmd = participantCommand(row)
+    out_dir = args.outdir.replace('{participant}', participant)
+    os.makedirs(out_dir, exist_ok=True)
+    log_file = os.path.join(args.logdir, 'sub-' + participant + '_dcm2bids.log')
+
+    start = time.time()
+    for attempt in range(1, args.retries + 2):
+        with open(log_file, 'a') as log:
+            log.write('attempt ' + str(attempt) + ': ' + ' '.join(cmd) + '\n')
+            log.flush()
+            result = subprocess.run(cmd, cwd=out_dir, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode == 0:
+            break
+        print('  sub-' + participant + ' failed (attempt ' + str(attempt) + '), see ' + log_file)
+    seconds = time.time() - start
+    ok = result.returncode == 0
+    print('  sub-' + participant + (' done' if ok else ' FAILED') + ' in ' + str(round(seconds, 1)) + ' s')
+    return participant, ok, attempt, seconds
+
+
+if not os.path.exists(args.config):
+    print(args.config + ' does not exist')
+    exit(1)
+
+participants = readConfig(args.config)
+if args.participants:
+    participants = [row for row in participants if row['BIDS_participant'] in args.participants]
+if not participants:
+    print('No participants found in ' + args.config)
+    exit(1)
+
+# relative paths in the commands are relative to where this script is started
+for option in ['dicomdir', 'donor_dcm']:
+    value = getattr(args, option)
+    if isinstance(value, list):
+        setattr(args, option, [os.path.abspath(v) for v in value])
+    elif value:
+        setattr(args, option, os.path.abspath(value))
+for row in participants:
+    for option in ['dicomdir', 'donor_dcm']:
+        if row.get(option) and row[option] != 'NA':
+            row[option] = ' '.join(os.path.abspath(v) for v in row[option].split())
+
+os.makedirs(args.logdir, exist_ok=True)
+print('Converting ' + str(len(participants)) + ' participants of ' + args.config + ' with ' + str(args.ncpu) + ' workers')
+start = time.time()
+with ThreadPoolExecutor(max_workers=max(1, args.ncpu)) as executor:
+    results = list(executor.map(convertParticipant, participants))
+
+# report
+failed = [r[0] for r in results if not r[1]]
+print('participant\tstatus\tattempts\tseconds')
+for participant, ok, attempts, seconds in results:
+    print(participant + '\t' + ('ok' if ok else 'failed') + '\t' + str(attempts) + '\t' + str(round(seconds, 1)))
+print('Total wall time: ' + str(round(time.time() - start, 1)) + ' s')
+
+if failed:
+    print('The conversion of ' + ', '.join(failed) + ' failed')
+    exit(1)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# Persistent index of the dicom series in a directory
+#
+# The headers of all dicom files are read once (without pixel data) and kept in a json file
+# (by default .KUL_dcm_index_<hash of the dicom directory>.json in the working directory, the dicom
+# directory itself is never written to, it may be read-only or archived). Next time only files that are new,
+# or whose mtime or size changed, are read again and files that are gone are dropped.
+# The index maps series number, series description and image type (e.g. M_FFE, PHASE) to
+# the list of files, so converters only need to read the files of the series they convert.
+#
+# Use as a module:
+#   import KUL_dcm_index
+#   index = KUL_dcm_index.buildIndex(dicomdir)
+#   files = KUL_dcm_index.findFiles(index, seriesnumber=301, imagetype='M_FFE')
+#
+# or from the command line:
+#   KUL_dcm_index.py dicomdir -n 301 -t M_FFE     (list the files of a series)
+#   KUL_dcm_index.py dicomdir -l                  (list the series)
+#   KUL_dcm_index.py dicomdir --dump              (one line per file, like the dcminfo dump of KUL_dcm2bids.sh)
+#
+# Needs pydicom
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+
+index_name = '.KUL_dcm_index'
+index_version = 2
+
+# the header fields kept per file
+header_tags = {'SeriesNumber': 0x00200011,
+               'SeriesDescription': 0x0008103E,
+               'ImageType': 0x00080008,
+               'Manufacturer': 0x00080070,
+               'SeriesInstanceUID': 0x0020000E,
+               'InstanceNumber': 0x00200013,
+               'SOPInstanceUID': 0x00080018}
+
+
+# a function to read the header fields of one file, None if it is not a dicom file
+def readHeader(dcm_file):
+    try:
+        ds = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=list(header_tags.values()))
+    except Exception:
+        return None
+    if 'SeriesInstanceUID' not in ds and 'SeriesNumber' not in ds:
+        return None
+    header = {}
+    for key in header_tags:
+        value = ds.get(key)
+        if value is None or value == '':
+            header[key] = None
+        elif key == 'ImageType':
+            header[key] = [str(v) for v in value] if isinstance(value, pydicom.multival.MultiValue) else [str(value)]
+        elif key in ['SeriesNumber', 'InstanceNumber']:
+            header[key] = int(value)
+        else:
+            header[key] = str(value)
+    return header
+
+def listFiles(dcm_dir):
+    # all files below dcm_dir (following links), with their mtime and size
+    files = {}
+    for root, dirs, names in os.walk(dcm_dir, followlinks=True):
+        dirs.sort()
+        for name in sorted(names):
+            if name.startswith(index_name) or name == 'DICOMDIR':
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files[os.path.relpath(path, dcm_dir)] = [st.st_mtime, st.st_size]
+    return files
+
+def defaultIndexFile(dcm_dir):
+    # an index file in the working directory, named after the dicom directory
+    key = hashlib.sha1(os.path.abspath(dcm_dir).encode()).hexdigest()[:12]
+    return os.path.join(os.getcwd(), index_name + '_' + key + '.json')
+
+def loadIndex(index_file, dcm_dir):
+    # the index is only reused for the same dicom directory
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('version') == index_version and index.get('dicomdir') == os.path.abspath(dcm_dir):
+            return index
+    except (OSError, ValueError):
+        pass
+    return None
+
+def saveIndex(index, index_file):
+    # write to a temporary file and rename, so a crash never leaves half an index
+    tmp_file = index_file + '.tmp' + str(os.getpid())
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print('Could not write the dicom index ' + index_file + ': ' + str(e), file=sys.stderr)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def buildIndex(dcm_dir, index_file=None, ncpu=None, verbose=False):
+    # build or update the index of dcm_dir, only new or changed files are read
+    if index_file is None:
+        index_file = defaultIndexFile(dcm_dir)
+    old = loadIndex(index_file, dcm_dir)
+    old_files = old['files'] if old else {}
+
+    files = listFiles(dcm_dir)
+    index = {'version': index_version, 'dicomdir': os.path.abspath(dcm_dir), 'files': {}}
+    to_read = []
+    for rel, stat in files.items():
+        entry = old_files.get(rel)
+        if entry is not None and entry['mtime'] == stat[0] and entry['size'] == stat[1]:
+            index['files'][rel] = entry
+        else:
+            to_read.append(rel)
+
+    if to_read:
+        if verbose:
+            print('Reading ' + str(len(to_read)) + ' of ' + str(len(files)) + ' files in ' + dcm_dir, file=sys.stderr)
+        paths = [os.path.join(dcm_dir, rel) for rel in to_read]
+        # threads and not processes: buildIndex is called from scripts without a main guard (KUL_dcm2bids.py),
+        # which a spawn or forkserver process pool would run again in every worker
+        with ThreadPoolExecutor(max_workers=ncpu) as executor:
+            headers = list(executor.map(readHeader, paths))
+        for rel, header in zip(to_read, headers):
+            # non dicom files are kept too (header None), so they are not read again
+            index['files'][rel] = {'mtime': files[rel][0], 'size': files[rel][1], 'header': header}
+
+    if to_read or len(old_files) != len(index['files']):
+        saveIndex(index, index_file)
+    return index
+
+def matchImageType(header, imagetype):
+    # imagetype matches one of the values (e.g. M_FFE) or the joined image type (e.g. ORIGINAL\PRIMARY)
+    values = header['ImageType'] or []
+    return imagetype in values or imagetype in '\\'.join(values)
+
+def findFiles(index, seriesnumber=None, description=None, imagetype=None, original=False):
+    # absolute paths of the files of a series, sorted on instance number
+    found = []
+    for rel, entry in index['files'].items():
+        header = entry['header']
+        if header is None:
+            continue
+        if seriesnumber is not None and header['SeriesNumber'] != int(seriesnumber):
+            continue
+        if description is not None and description not in (header['SeriesDescription'] or ''):
+            continue
+        if imagetype is not None and not matchImageType(header, imagetype):
+            continue
+        if original and not matchImageType(header, 'ORIGINAL'):
+            continue
+        found.append((header['InstanceNumber'] or 0, rel))
+    return [os.path.join(index['dicomdir'], rel) for n, rel in sorted(found)]
+
+def fingerprint(index, files):
+    # a hash of a set of files from the index: their SOP instance UIDs and sizes,
+    # so it does not change when the same dicoms are copied or extracted again
+    items = []
+    for f in files:
+        entry = index['files'][os.path.relpath(f, index['dicomdir'])]
+        items.append((entry['header']['SOPInstanceUID'] or os.path.basename(f), entry['size']))
+    return hashlib.sha256(json.dumps(sorted(items)).encode()).hexdigest()
+
+def listSeries(index):
+    # one entry per series number, description and image type, with the number of files
+    series = {}
+    for entry in index['files'].values():
+        header = entry['header']
+        if header is None:
+            continue
+        key = (header['SeriesNumber'] or 0, header['SeriesDescription'] or '', '\\'.join(header['ImageType'] or []))
+        series[key] = series.get(key, 0) + 1
+    return [{'SeriesNumber': k[0], 'SeriesDescription': k[1], 'ImageType': k[2], 'files': n}
+            for k, n in sorted(series.items())]
+
+def dumpLine(path, header):
+    # same layout as the dcminfo dump in KUL_dcm2bids.sh: file [0008,103E] ... [0008,0008] ... [0008,0070] ...
+    return path + ' [0008,103E] ' + (header['SeriesDescription'] or '') + \
+        ' [0008,0008] ' + ' '.join(header['ImageType'] or []) + \
+        ' [0008,0070] ' + (header['Manufacturer'] or '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a persistent index of the dicom series in a directory",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("dicomdir", help="dicom directory")
+    parser.add_argument("-i", "--index",
+                        help="index file, default " + index_name + "_<hash of the dicom directory>.json in the working directory")
+    parser.add_argument("-n", "--seriesnumber", type=int, help="list the files of this series number")
+    parser.add_argument("-d", "--seriesdescription", help="list the files whose series description contains this")
+    parser.add_argument("-t", "--imagetype", help="list the files with this image type, e.g. M_FFE")
+    parser.add_argument("-l", "--list", action="store_true", help="list the series")
+    parser.add_argument("--dump", action="store_true", help="print one line per dicom file like the KUL_dcm2bids.sh dump")
+    parser.add_argument("-j", "--ncpu", type=int, default=os.cpu_count(), help="number of threads reading headers")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dicomdir):
+        print(args.dicomdir + ' does not exist')
+        exit(1)
+
+    index = buildIndex(args.dicomdir, args.index, args.ncpu, args.verbose)
+
+    if args.dump:
+        for rel, entry in index['files'].items():
+            if entry['header'] is not None:
+                print(dumpLine(os.path.join(args.dicomdir, rel), entry['header']))
+    elif args.list:
+        for s in listSeries(index):
+            print(str(s['SeriesNumber']) + '\t' + s['SeriesDescription'] + '\t' + s['ImageType'] + '\t' + str(s['files']))
+    elif args.seriesnumber is not None or args.seriesdescription or args.imagetype:
+        for f in findFiles(index, args.seriesnumber, args.seriesdescription, args.imagetype):
+            print(f)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,46 @@
 # Convert nifti to dicom given a donor dicom image
 # Stefan Sunaert - 27/02/2023
 # Mainly based on SimpleITK - https://simpleitk.readthedocs.io/en/master/link_DicomSeriesFromArray_docs.html
+#
+# Batch mode (-b): the nifti argument is a csv manifest with a header and the columns
+#   nifti,seriesdescription,seriesnumber[,dicomdir]
+# the donor is read once and all series are converted in one process, in parallel,
+# each with its own series instance UID. Every series is written to dicomdir/<dicomdir column>,
+# or to dicomdir/<name of the nifti> if that column is empty or missing, the rows must not share a directory.
+#
+# Multi-frame mode (-m): every series is written as one enhanced MR image storage file
+# (000000.dcm) with per-frame plane position functional groups instead of one file per slice.
+# This needs pydicom (pip install pydicom).
+#
+# Send mode (--send host:port:AET): the series are not written to disk but sent to a DICOM
+# storage SCP, one association per series and several series in parallel in batch mode.
+# This needs pydicom and pynetdicom (pip install pynetdicom). To test, run a local storage SCP:
+#   python -m pynetdicom storescp -od received 11112
+# and send to localhost:11112:STORESCP
 
 import SimpleITK as sitk
 import argparse
 import sys
 import time
 import os
+import csv
 import shutil
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+# pydicom is only needed for the multi-frame output
+try:
+    import pydicom
+    from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+    from pydicom.sequence import Sequence
+    from pydicom.datadict import dictionary_VR
+except ImportError:
+    pydicom = None
+# pynetdicom is only needed to send to a DICOM node
+try:
+    from pynetdicom import AE
+except ImportError:
+    AE = None
 
 
 # Get and check commandline
@@ -19,17 +51,110 @@ parser = argparse.ArgumentParser(description="Convert a nifti or 3d-tiff to dico
 parser.add_argument("-v", "--verbose", action="store_true", help="increase verbosity")
 parser.add_argument("-s", "--seriesdescription")
 parser.add_argument("-n", "--seriesnumber")
-parser.add_argument("nifti", help="nifti or 3d-tiff image")
+parser.add_argument("-j", "--ncpu", type=int, default=os.cpu_count(), help="number of threads writing slices")
+parser.add_argument("-b", "--batch", action="store_true",
+                    help="the nifti argument is a csv manifest (nifti,seriesdescription,seriesnumber[,dicomdir])")
+parser.add_argument("-m", "--multiframe", action="store_true",
+                    help="write every series as one enhanced (multi-frame) MR dicom file, needs pydicom")
+parser.add_argument("--send", help="send the series to a dicom node given as host:port:AET instead of writing them, "
+                                   "needs pydicom and pynetdicom")
+parser.add_argument("nifti", help="nifti or 3d-tiff image (csv manifest in batch mode)")
 parser.add_argument("donor", help="dicom donor image")
-parser.add_argument("dicomdir", help="dicom output directory")
+parser.add_argument("dicomdir", nargs='?',
+                    help="dicom output directory (parent directory of the series in batch mode), not used with --send")
 args = parser.parse_args()
 config = vars(args)
 #print(config)
 
 
 # Define functions
-def writeSlices(series_tag_values, new_img, out_dir, i):
-    image_slice = new_img[:, :, i]
+# every thread gets its own writer, an ImageFileWriter can not be shared between threads
+thread_data = threading.local()
+
+def getWriter():
+    if not hasattr(thread_data, 'writer'):
+        thread_data.writer = sitk.ImageFileWriter()
+        # Use the study/series/frame of reference information given in the meta-data
+        # dictionary and not the automatically generated information from the file IO
+        thread_data.writer.KeepOriginalImageUIDOn()
+    return thread_data.writer
+
+class LPSView:
+    # The LPS oriented geometry of an image, without reorienting (copying) its pixels
+    # DICOMOrient would permute and flip the whole volume, here only the permutation and flips
+    # are taken from the orient filter and applied to one slice at a time in getSlice
+    # the methods used on the oriented image (GetDepth, GetSpacing, GetDirection,
+    # TransformIndexToPhysicalPoint) give the same values as on the DICOMOrient output
+    def __init__(self, img, orient=True):
+        self.img = img
+        self.perm = [0, 1, 2]
+        self.flip = [False, False, False]
+        if orient:
+            # the permutation and flips only depend on the direction, run the filter on a tiny image
+            orient_filter = sitk.DICOMOrientImageFilter()
+            orient_filter.SetDesiredCoordinateOrientation("LPS")
+            probe = sitk.Image([2, 2, 2], sitk.sitkUInt8)
+            probe.SetDirection(img.GetDirection())
+            orient_filter.Execute(probe)
+            self.perm = list(orient_filter.GetPermuteOrder())
+            self.flip = list(orient_filter.GetFlipAxes())
+        direction = np.array(img.GetDirection()).reshape(3, 3)
+        size = img.GetSize()
+        self.size = [size[p] for p in self.perm]
+        self.spacing = [img.GetSpacing()[p] for p in self.perm]
+        # + 0.0 turns the -0.0 of flipped zero cosines into 0.0, as in the DICOMOrient output
+        self.direction = np.stack([direction[:, p] * (-1 if f else 1) for p, f in zip(self.perm, self.flip)], axis=1) + 0.0
+        # the first voxel of the oriented image is the last voxel along every flipped axis
+        first = [0, 0, 0]
+        for p, f in zip(self.perm, self.flip):
+            first[p] = size[p] - 1 if f else 0
+        self.origin = np.array(img.TransformIndexToPhysicalPoint(first))
+
+    def GetDepth(self):
+        return self.size[2]
+
+    def GetSpacing(self):
+        return tuple(self.spacing)
+
+    def GetDirection(self):
+        return tuple(self.direction.flatten())
+
+    def TransformIndexToPhysicalPoint(self, index):
+        return tuple(self.origin + self.direction @ (np.array(self.spacing) * index))
+
+    def slice(self, i):
+        # slice i of the oriented image, extracted from the source along the permuted axis
+        axis = self.perm[2]
+        k = self.size[2] - 1 - i if self.flip[2] else i
+        index = [slice(None)] * 3
+        index[axis] = k
+        image_slice = self.img[tuple(index)]
+        # the remaining source axes are kept in ascending order, put them in the oriented order
+        if self.perm[0] > self.perm[1]:
+            image_slice = sitk.PermuteAxes(image_slice, [1, 0])
+        if self.flip[0] or self.flip[1]:
+            image_slice = sitk.Flip(image_slice, self.flip[:2])
+        # the geometry of the slice as if it was cut from the oriented image
+        image_slice.SetOrigin(self.TransformIndexToPhysicalPoint((0, 0, i)))
+        image_slice.SetSpacing(self.spacing[:2])
+        sub = self.direction[:2, :2]
+        if abs(np.linalg.det(sub)) < 1e-6:
+            sub = np.eye(2)
+        image_slice.SetDirection(tuple(sub.flatten()))
+        return image_slice
+
+
+def getSlice(new_img, i, scale=None):
+    image_slice = new_img.slice(i)
+    if scale is not None:
+        # rescale to int16 one slice at a time, truncated like the former numpy astype
+        # float32 images are scaled in float32 and all others in float64, as numpy did
+        work_type = sitk.sitkFloat32 if isinstance(scale, np.float32) else sitk.sitkFloat64
+        image_slice = sitk.Cast(sitk.Cast(image_slice, work_type) * float(scale), sitk.sitkInt16)
+    return image_slice
+
+def writeSlices(series_tag_values, new_img, out_dir, i, scale=None):
+    image_slice = getSlice(new_img, i, scale)
 
     # Tags shared by the series.
     list(
@@ -42,10 +167,12 @@ def writeSlices(series_tag_values, new_img, out_dir, i):
     )
 
     # Slice specific tags.
+    # the creation date and time are taken once for the series, so all slices get the same
+    # values whatever thread writes them and whenever
     #   Instance Creation Date
-    image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d"))
+    image_slice.SetMetaData("0008|0012", modification_date)
     #   Instance Creation Time
-    image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S"))
+    image_slice.SetMetaData("0008|0013", modification_time)
 
     # Setting the type to CT so that the slice location is preserved and
     # the thickness is carried over.
@@ -63,53 +190,400 @@ def writeSlices(series_tag_values, new_img, out_dir, i):
 
     # Write to the output directory and add the extension dcm, to force
     # writing in DICOM format.
+    writer = getWriter()
     writer.SetFileName(os.path.join(out_dir, str(i).rjust(6, '0') + ".dcm"))
     writer.Execute(image_slice)
 
+def dsValues(values):
+    # decimal strings are limited to 16 characters, let pydicom round them
+    return [pydicom.valuerep.DSfloat(v, auto_format=True) for v in values]
 
+def newDataset(file_name, sop_class, sop_instance, series_tag_values, skip):
+    # pydicom dataset with the file meta information and the donor and series tags,
+    # the tags in skip are set by the caller
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class
+    file_meta.MediaStorageSOPInstanceUID = sop_instance
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds = FileDataset(file_name, {}, file_meta=file_meta, preamble=b"\0" * 128)
+
+    for k, v in series_tag_values:
+        if k in skip:
+            continue
+        tag = int(k.replace("|", ""), 16)
+        try:
+            vr = dictionary_VR(tag)
+        except KeyError:
+            continue
+        ds.add_new(tag, vr, v.strip(" \0"))
+
+    ds.SOPClassUID = sop_class
+    ds.SOPInstanceUID = sop_instance
+    ds.FrameOfReferenceUID = dict(series_tag_values)["0020|000e"] + ".0"
+    ds.InstanceCreationDate = modification_date
+    ds.InstanceCreationTime = modification_time
+    ds.ContentDate = modification_date
+    ds.ContentTime = modification_time
+    return ds
+
+def setPixelData(ds, pixels, rgb):
+    # image pixel module from a numpy array, rgb pixels have the samples as last axis
+    if rgb:
+        # e.g. an rgb 3d-tiff
+        ds.SamplesPerPixel = pixels.shape[-1]
+        ds.PhotometricInterpretation = "RGB"
+        ds.PlanarConfiguration = 0
+        ds.Rows, ds.Columns = pixels.shape[-3:-1]
+    else:
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.Rows, ds.Columns = pixels.shape[-2:]
+    ds.BitsAllocated = pixels.dtype.itemsize * 8
+    ds.BitsStored = ds.BitsAllocated
+    ds.HighBit = ds.BitsAllocated - 1
+    ds.PixelRepresentation = 1 if pixels.dtype.kind == "i" else 0
+    ds.PixelData = pixels.astype(pixels.dtype.newbyteorder("<")).tobytes()
+
+def sliceSopClass(series_tag_values):
+    # MR Image Storage, unless the donor gives another single-frame storage class
+    sop_class = dict(series_tag_values).get("0008|0016", "").strip(" \0") or "1.2.840.10008.5.1.4.1.1.4"
+    if sop_class == "1.2.840.10008.5.1.4.1.1.4.1":
+        sop_class = "1.2.840.10008.5.1.4.1.1.4"
+    return sop_class
+
+def sliceDataset(series_tag_values, new_img, i, scale=None):
+    # A single slice as a classic single-frame pydicom dataset, with the same tags as writeSlices
+    # used to send slices over the network without writing them to disk
+    sop_instance = dict(series_tag_values)["0020|000e"] + ".1." + str(i + 1)
+    ds = newDataset(str(i).rjust(6, '0') + ".dcm", sliceSopClass(series_tag_values), sop_instance, series_tag_values,
+                    ["0002|0002", "0008|0016", "0020|0037"])
+
+    direction = new_img.GetDirection()
+    spacing = new_img.GetSpacing()
+    ds.ImageOrientationPatient = dsValues([direction[0], direction[3], direction[6],
+                                           direction[1], direction[4], direction[7]])
+    ds.ImagePositionPatient = dsValues(new_img.TransformIndexToPhysicalPoint((0, 0, i)))
+    ds.PixelSpacing = dsValues([spacing[1], spacing[0]])
+    ds.SliceThickness = dsValues([spacing[2]])[0]
+    ds.InstanceNumber = i
+
+    pixels = sitk.GetArrayFromImage(getSlice(new_img, i, scale))
+    setPixelData(ds, pixels, pixels.ndim == 3)
+    return ds
+
+def mrImageDescription(ds):
+    # MR Image Description macro, for the Enhanced MR image module and the MR Image Frame Type group
+    # the values of a derived magnitude volume with no known contrast
+    ds.PixelPresentation = "MONOCHROME"
+    ds.VolumetricProperties = "VOLUME"
+    ds.VolumeBasedCalculationTechnique = "NONE"
+    ds.ComplexImageComponent = "MAGNITUDE"
+    ds.AcquisitionContrast = "UNKNOWN"
+
+def multiframeDataset(series_tag_values, new_img, scale=None):
+    # The series as a single enhanced MR image storage object (multi-frame)
+    # the donor and series tags are the same as for the single frame files, the orientation,
+    # spacing and slice positions go into the shared and per-frame functional groups
+    # the Type 1 attributes of the Enhanced MR IOD that do not apply to derived images are
+    # given fixed values (magnitude, unknown contrast, brain, KUL_NIS as equipment)
+    series_uid = dict(series_tag_values)["0020|000e"]
+    sop_class = "1.2.840.10008.5.1.4.1.1.4.1"  # Enhanced MR Image Storage
+    ds = newDataset(str(0).rjust(6, '0') + ".dcm", sop_class, series_uid + ".1", series_tag_values,
+                    ["0002|0002", "0008|0016", "0008|0008", "0020|0037"])
+    image_type = ["DERIVED", "SECONDARY", "VOLUME", "NONE"]
+    ds.ImageType = image_type
+    ds.InstanceNumber = 1
+    ds.ContentQualification = "RESEARCH"
+    mrImageDescription(ds)
+    ds.BurnedInAnnotation = "NO"
+    ds.LossyImageCompression = "00"
+    ds.PresentationLUTShape = "IDENTITY"
+    # Type 1 of the MR series, enhanced general equipment and acquisition context modules
+    # the MR series module needs modality MR, whatever the donor is
+    ds.Modality = "MR"
+    ds.PositionReferenceIndicator = ""
+    ds.Manufacturer = "KUL_NIS"
+    ds.ManufacturerModelName = "KUL_nii2dcm.py"
+    ds.DeviceSerialNumber = "0"
+    ds.SoftwareVersions = "KUL_nii2dcm.py"
+    ds.AcquisitionContextSequence = Sequence([])
+
+    # Pixel data, frames are the slices in the same order as the single frame files
+    depth = new_img.GetDepth()
+    frames = np.stack([sitk.GetArrayFromImage(getSlice(new_img, i, scale)) for i in range(depth)])
+    ds.NumberOfFrames = depth
+    setPixelData(ds, frames, frames.ndim == 4)
+
+    # Shared functional groups: orientation, spacing and pixel value transformation
+    direction = new_img.GetDirection()
+    spacing = new_img.GetSpacing()
+    shared = Dataset()
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = dsValues([direction[0], direction[3], direction[6],
+                                                    direction[1], direction[4], direction[7]])
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    measures = Dataset()
+    measures.PixelSpacing = dsValues([spacing[1], spacing[0]])
+    measures.SliceThickness = dsValues([spacing[2]])[0]
+    measures.SpacingBetweenSlices = dsValues([spacing[2]])[0]
+    shared.PixelMeasuresSequence = Sequence([measures])
+    transformation = Dataset()
+    transformation.RescaleIntercept = 0
+    transformation.RescaleSlope = 1
+    transformation.RescaleType = "US"
+    shared.PixelValueTransformationSequence = Sequence([transformation])
+    frame_type = Dataset()
+    frame_type.FrameType = image_type
+    mrImageDescription(frame_type)
+    shared.MRImageFrameTypeSequence = Sequence([frame_type])
+    # the anatomy is not known from the nifti, the brain (SNOMED CT) as for all KUL_NIS data
+    region = Dataset()
+    region.CodeValue = "12738006"
+    region.CodingSchemeDesignator = "SCT"
+    region.CodeMeaning = "Brain"
+    anatomy = Dataset()
+    anatomy.FrameLaterality = "U"
+    anatomy.AnatomicRegionSequence = Sequence([region])
+    shared.FrameAnatomySequence = Sequence([anatomy])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    # Dimensions: the frames are indexed by their position in the stack
+    dimension_uid = series_uid + ".2"
+    organization = Dataset()
+    organization.DimensionOrganizationUID = dimension_uid
+    ds.DimensionOrganizationSequence = Sequence([organization])
+    index = Dataset()
+    index.DimensionOrganizationUID = dimension_uid
+    index.DimensionIndexPointer = 0x00209057  # In-Stack Position Number
+    index.FunctionalGroupPointer = 0x00209111  # Frame Content Sequence
+    ds.DimensionIndexSequence = Sequence([index])
+
+    # Per-frame functional groups: the position of every slice
+    per_frame = []
+    for i in range(depth):
+        frame = Dataset()
+        content = Dataset()
+        content.StackID = "1"
+        content.InStackPositionNumber = i + 1
+        content.DimensionIndexValues = [i + 1]
+        frame.FrameContentSequence = Sequence([content])
+        position = Dataset()
+        position.ImagePositionPatient = dsValues(new_img.TransformIndexToPhysicalPoint((0, 0, i)))
+        frame.PlanePositionSequence = Sequence([position])
+        per_frame.append(frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frame)
+    return ds
+
+def writeMultiframe(series_tag_values, new_img, out_dir, scale=None):
+    ds = multiframeDataset(series_tag_values, new_img, scale)
+    pydicom.dcmwrite(os.path.join(out_dir, ds.filename), ds, write_like_original=False)
+
+def parseDestination(send):
+    # host:port:AET
+    try:
+        host, port, aet = send.rsplit(':', 2)
+        return host, int(port), aet
+    except ValueError:
+        print('The destination should be given as host:port:AET, not ' + send)
+        exit(1)
+
+def sendSeries(datasets, sop_class, destination, label):
+    # Send the datasets of one series to a DICOM storage SCP over a single association
+    # the datasets are made one by one while sending, nothing is written to disk
+    host, port, aet = destination
+    ae = AE(ae_title='KUL_NII2DCM')
+    ae.add_requested_context(sop_class, [pydicom.uid.ExplicitVRLittleEndian, pydicom.uid.ImplicitVRLittleEndian])
+    assoc = ae.associate(host, port, ae_title=aet)
+    if not assoc.is_established:
+        raise RuntimeError('no association with ' + aet + ' on ' + host + ':' + str(port))
+    n_sent = 0
+    n_failed = 0
+    try:
+        for ds in datasets:
+            status = assoc.send_c_store(ds)
+            if status and status.Status == 0x0000:
+                n_sent += 1
+            else:
+                n_failed += 1
+    finally:
+        assoc.release()
+    print('Sent ' + str(n_sent) + ' object(s) of ' + label + ' to ' + aet + ' on ' + host + ':' + str(port))
+    if n_failed:
+        raise RuntimeError(str(n_failed) + ' object(s) of ' + label + ' were not stored by ' + aet)
+
+
+def readDonor(donor_dcm):
+    # Read the donor DICOM
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(donor_dcm)
+    reader.LoadPrivateTagsOn()
+    reader.ReadImageInformation()
+
+    # Display the tags
+    if args.verbose:
+        for k in reader.GetMetaDataKeys():
+            v = reader.GetMetaData(k)
+            try:
+                print(f'({k}) = = "{v}"')
+            except:
+                print("An exception occurred")
+
+    # the tags copied from the donor are taken once and shared by all series
+    return [
+        (k, reader.GetMetaData(k))
+        for k in tags_to_copy
+        if reader.HasMetaDataKey(k)
+    ]
+
+
+def readImage(nifti_input):
+    img_input, img_ext = os.path.splitext(nifti_input)
+    if img_ext == '.tiff':
+        tiff=1
+        print('Assuming ' + nifti_input + ' is a 3d-tiff')
+    else:
+        tiff=0
+        print('Assuming ' + nifti_input + ' is nifti')
+
+    # Read the nii or tiff
+    nii_img = sitk.ReadImage(nifti_input)
+
+    if tiff == 0:
+        # Convert the data to int16
+        # only the global maximum is computed here, the rescale itself is done slice by slice
+        # in writeSlices, so no float64 or int16 copy of the whole volume is made
+        print('Converting ' + nifti_input + ' to 16bit')
+        min_max = sitk.MinimumMaximumImageFilter()
+        min_max.Execute(nii_img)
+        max = min_max.GetMaximum()
+        #print(max)
+        if nii_img.GetPixelID() == sitk.sitkFloat32:
+            scale = np.float32(np.iinfo(np.int16).max) / np.float32(max)
+        else:
+            scale = np.iinfo(np.int16).max / max
+        # the image is not reoriented as a whole, the slices are taken in LPS order one by one
+        new_img = LPSView(nii_img)
+    else:
+        new_img = LPSView(nii_img, orient=False)
+        scale = None
+
+    '''
+    # Check the data type and set spacing in case of TIFF
+    try:
+        print(nii_img.GetMetaData('nifti_type'))
+        print('Input is a nifti')
+    except:
+        print('Input is not nifti, probably TIFF; setting spacing to 1,1,1')
+        new_img.SetSpacing([1.0, 1.0, 1.0])
+    '''
+    return new_img, scale
+
+
+def seriesTags(series_tag_values_a, new_img, seriesdesc, seriesnumber, series_index=None):
+    # Copy some of the tags and add the relevant tags indicating the change.
+    # For the series instance UID (0020|000e), each of the components is a number,
+    # cannot start with zero, and separated by a '.' We create a unique series ID
+    # using the date and time. In batch mode all series share the date and time,
+    # the index of the series in the manifest is appended to keep the UIDs distinct.
+    # Tags of interest:
+    series_uid = "1.2.826.0.1.3680043.2.1125." + modification_date + ".1" + modification_time
+    if series_index is not None:
+        series_uid += "." + str(series_index + 1)
+    direction = new_img.GetDirection()
+    series_tag_values_b = [
+        ("0008|0031", modification_time),  # Series Time
+        ("0008|0021", modification_date),  # Series Date
+        ("0008|0008", "DERIVED\\SECONDARY"),  # Image Type
+        ("0020|000e", series_uid),  # Series Instance UID
+        (
+            "0020|0037",
+            "\\".join(
+                map(
+                    str,
+                    (
+                        direction[0],
+                        direction[3],
+                        direction[6],
+                        direction[1],
+                        direction[4],
+                        direction[7],
+                    ),
+                )
+            ),
+        ),  # Image Orientation
+        ("0008|103e", seriesdesc),  # Series Description
+        ("0020|0011", seriesnumber),  # Series Description
+    ]
+    return series_tag_values_a + series_tag_values_b
+
+
+def writeSeries(donor_tags, nifti_input, dcm_output, seriesdesc, seriesnumber, ncpu, series_index=None):
+    new_img, scale = readImage(nifti_input)
+    series_tag_values = seriesTags(donor_tags, new_img, seriesdesc, seriesnumber, series_index)
+
+    # Give info
+    print('Incorporating the following dicom tags for ' + (dcm_output or nifti_input) + ':')
+    print(series_tag_values)
+
+    if args.send:
+        if args.multiframe:
+            datasets = [multiframeDataset(series_tag_values, new_img, scale)]
+            sop_class = "1.2.840.10008.5.1.4.1.1.4.1"
+        else:
+            datasets = (sliceDataset(series_tag_values, new_img, i, scale) for i in range(new_img.GetDepth()))
+            sop_class = sliceSopClass(series_tag_values)
+        sendSeries(datasets, sop_class, destination, dcm_output or nifti_input)
+        return
+
+    # Clean and Make the output dir
+    if os.path.exists(dcm_output):
+        shutil.rmtree(dcm_output)
+    os.makedirs(dcm_output, exist_ok=True)
+
+    if args.multiframe:
+        writeMultiframe(series_tag_values, new_img, dcm_output, scale)
+        return
+
+    # Write slices to output directory, encoding and writing of the slices is done by a pool of threads
+    # file names, instance numbers and tags only depend on the slice index, so the output is the same
+    # as when written one by one
+    with ThreadPoolExecutor(max_workers=max(1, ncpu)) as executor:
+        list(
+            executor.map(
+                lambda i: writeSlices(series_tag_values, new_img, dcm_output, i, scale),
+                range(new_img.GetDepth()),
+            )
+        )
+
+
+def readManifest(manifest):
+    # rows of the manifest as dicts, empty lines and lines starting with # are skipped
+    series = []
+    with open(manifest, newline='') as file_handler:
+        rows = csv.DictReader(line for line in file_handler if line.strip() and not line.startswith('#'))
+        for row in rows:
+            row = {k.strip(): (v or '').strip() for k, v in row.items() if k}
+            if not row.get('nifti'):
+                print('No nifti given in ' + manifest + ' for row ' + str(row))
+                exit(1)
+            if not os.path.exists(row['nifti']):
+                print(row['nifti'] + ' does not exist')
+                exit(1)
+            if not row.get('seriesdescription'):
+                row['seriesdescription'] = 'IKTsimple - KUL_NIS'
+            row.setdefault('seriesnumber', '')
+            if not row.get('dicomdir'):
+                row['dicomdir'] = os.path.basename(row['nifti']).split('.')[0]
+            # every series is cleaned and written by its own thread, two rows can not share a directory
+            dicomdirs = [os.path.normpath(other['dicomdir']) for other in series]
+            if os.path.normpath(row['dicomdir']) in dicomdirs:
+                print('The dicomdir ' + row['dicomdir'] + ' of ' + row['nifti'] + ' is already used by '
+                      + series[dicomdirs.index(os.path.normpath(row['dicomdir']))]['nifti']
+                      + ', give the rows a distinct dicomdir in ' + manifest)
+                exit(1)
+            series.append(row)
+    return series
 
-# set inputs and check
-donor_dcm = args.donor
-if not os.path.exists(donor_dcm):
-    print(donor_dcm + ' does not exist')
-    exit(1)
-nifti_input = args.nifti
-if not os.path.exists(nifti_input):
-    print(nifti_input + ' does not exist')
-    exit(1)
-img_input, img_ext = os.path.splitext(nifti_input)
-if img_ext == '.tiff':
-    tiff=1
-    print('Assuming input is a 3d-tiff')
-else:
-    tiff=0
-    print('Assuming input is nifti')
-dcm_output = args.dicomdir
-
-# set defaults
-if args.seriesdescription:
-    seriesdesc = args.seriesdescription
-else:
-    seriesdesc = 'IKTsimple - KUL_NIS'
-if args.seriesnumber:
-    seriesnumber = args.seriesnumber
-else:
-    seriesnumber = ''
-
-# Read the donor DICOM
-reader = sitk.ImageFileReader()
-reader.SetFileName(donor_dcm)
-reader.LoadPrivateTagsOn()
-reader.ReadImageInformation()
-
-# Display the tags
-if args.verbose:
-    for k in reader.GetMetaDataKeys():
-        v = reader.GetMetaData(k)
-        try: 
-            print(f'({k}) = = "{v}"')
-        except:
-            print("An exception occurred")
 
 # Copy relevant tags from the original meta-data dictionary (private tags are
 # also accessible).
@@ -134,33 +608,6 @@ tags_to_copy = [
     "0008|0080",  # Institution Name
 ]
 
-# Read the nii or tiff
-nii_img = sitk.ReadImage(nifti_input)
-
-if tiff == 0:
-    # Convert the data to int16
-    print('Converting the nifti to 16bit')
-    np.img_data = sitk.GetArrayFromImage(nii_img)
-    max = np.amax(np.img_data)
-    #print(max)
-    img_int16 = np.img_data * ( np.iinfo(np.int16).max / max )
-    img_int16b = img_int16.astype(np.int16)
-    new_img = sitk.GetImageFromArray(img_int16b)
-    new_img.CopyInformation(nii_img)
-    new_img = sitk.DICOMOrient(new_img, "LPS")
-else:
-    new_img = nii_img
-
-'''
-# Check the data type and set spacing in case of TIFF
-try:
-    print(nii_img.GetMetaData('nifti_type'))
-    print('Input is a nifti')
-except:
-    print('Input is not nifti, probably TIFF; setting spacing to 1,1,1')
-    new_img.SetSpacing([1.0, 1.0, 1.0])
-'''
-
 # Write the 3D image as a series
 # IMPORTANT: There are many DICOM tags that need to be updated when you modify
 #            an original image. This is a delicate operation and requires
@@ -172,73 +619,69 @@ except:
 #            the files:
 #                  http://www.dclunie.com/dicom3tools.html
 
-writer = sitk.ImageFileWriter()
-# Use the study/series/frame of reference information given in the meta-data
-# dictionary and not the automatically generated information from the file IO
-writer.KeepOriginalImageUIDOn()
-
 modification_time = time.strftime("%H%M%S")
 modification_date = time.strftime("%Y%m%d")
 
-# Copy some of the tags and add the relevant tags indicating the change.
-# For the series instance UID (0020|000e), each of the components is a number,
-# cannot start with zero, and separated by a '.' We create a unique series ID
-# using the date and time. Tags of interest:
-direction = new_img.GetDirection()
-series_tag_values_a = [
-    (k, reader.GetMetaData(k))
-    for k in tags_to_copy
-    if reader.HasMetaDataKey(k)
-] 
-series_tag_values_b = [
-    ("0008|0031", modification_time),  # Series Time
-    ("0008|0021", modification_date),  # Series Date
-    ("0008|0008", "DERIVED\\SECONDARY"),  # Image Type
-    (
-        "0020|000e",
-        "1.2.826.0.1.3680043.2.1125."
-        + modification_date
-        + ".1"
-        + modification_time,
-    ),  # Series Instance UID
-    (
-        "0020|0037",
-        "\\".join(
-            map(
-                str,
-                (
-                    direction[0],
-                    direction[3],
-                    direction[6],
-                    direction[1],
-                    direction[4],
-                    direction[7],
-                ),
-            )
-        ),
-    ),  # Image Orientation
-    ("0008|103e", seriesdesc),  # Series Description
-    ("0020|0011", seriesnumber),  # Series Description
-]
-series_tag_values = series_tag_values_a + series_tag_values_b
-
-# Give info
-print('Incorporating the following dicom tags:')
-#print(series_tag_values_a)
-#print(series_tag_values_b)
-print(series_tag_values)
-
-# Clean and Make the output dir
-if os.path.exists(dcm_output):
-    shutil.rmtree(dcm_output)
-os.makedirs(dcm_output, exist_ok=True)
-
-# Write slices to output directory
-list(
-    map(
-        lambda i: writeSlices(series_tag_values, new_img, dcm_output, i),
-        range(new_img.GetDepth()),
-    )
-)
+# set inputs and check
+if args.multiframe and pydicom is None:
+    print('Multi-frame output needs pydicom, please install it (pip install pydicom)')
+    exit(1)
+if args.send:
+    if pydicom is None or AE is None:
+        print('Sending needs pydicom and pynetdicom, please install them (pip install pydicom pynetdicom)')
+        exit(1)
+    destination = parseDestination(args.send)
+elif not args.dicomdir:
+    print('Give a dicom output directory or a destination with --send')
+    exit(1)
+donor_dcm = args.donor
+if not os.path.exists(donor_dcm):
+    print(donor_dcm + ' does not exist')
+    exit(1)
+nifti_input = args.nifti
+if not os.path.exists(nifti_input):
+    print(nifti_input + ' does not exist')
+    exit(1)
+# with --send the output directory is only used as the name of the series in the messages
+dcm_output = args.dicomdir or ''
+
+# the donor is read once, also in batch mode
+donor_tags = readDonor(donor_dcm)
+
+if not args.batch:
+    # set defaults
+    if args.seriesdescription:
+        seriesdesc = args.seriesdescription
+    else:
+        seriesdesc = 'IKTsimple - KUL_NIS'
+    if args.seriesnumber:
+        seriesnumber = args.seriesnumber
+    else:
+        seriesnumber = ''
+
+    writeSeries(donor_tags, nifti_input, dcm_output, seriesdesc, seriesnumber, args.ncpu)
+    sys.exit(0)
+
+# batch mode: the series are converted in parallel, the threads are shared out over the series
+series = readManifest(nifti_input)
+print('Converting ' + str(len(series)) + ' series from ' + nifti_input)
+n_series = max(1, min(args.ncpu, len(series)))
+slice_ncpu = max(1, args.ncpu // n_series)
+failed = []
+
+def batchSeries(index):
+    row = series[index]
+    try:
+        writeSeries(donor_tags, row['nifti'], os.path.join(dcm_output, row['dicomdir']),
+                    row['seriesdescription'], row['seriesnumber'], slice_ncpu, index)
+    except Exception as e:
+        print('Converting ' + row['nifti'] + ' failed: ' + str(e))
+        failed.append(row['nifti'])
+
+with ThreadPoolExecutor(max_workers=n_series) as executor:
+    list(executor.map(batchSeries, range(len(series))))
 
-sys.exit(0)
\ No newline at end of file
+if failed:
+    print('The following series failed: ' + ', '.join(failed))
+    sys.exit(1)
+sys.exit(0)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark of the distance engines of KUL_EDs_b2masks.py on synthetic masks
+# no patient data needed: spheres, tubes and tract-like (curved, varying radius) tubes
+# are generated at growing grid sizes and with isotropic and anisotropic voxel sizes
+#
+# for every case and every distance mode it records:
+#  - the runtime of the mask preparation and of the distance engine
+#  - the peak memory allocated during the engine (tracemalloc, includes numpy arrays)
+#  - whether the minimum distance and all tied voxel pairs agree with the brute force reference
+#    (for large cases the O(N x M) Python loop is too slow, the blocked engine is the reference then)
+#
+# exits with 1 if any engine disagrees with the reference, so it can be used as a regression check
+#
+# e.g.
+#   python3 debug/KUL_EDs_b2masks_benchmark.py
+#   python3 debug/KUL_EDs_b2masks_benchmark.py -s 64 128 192 -v 1,1,1 0.5,0.5,2 -o bench.csv
+
+import os, sys, time, argparse, tempfile, tracemalloc, csv, warnings
+import numpy as np
+import nibabel as nib
+
+# import the tool from the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import KUL_EDs_b2masks as eds
+
+warnings.simplefilter('ignore', DeprecationWarning)
+
+parser = argparse.ArgumentParser(description="Benchmark the distance engines of KUL_EDs_b2masks.py on synthetic masks",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--sizes", nargs='+', type=int, default=[32, 64, 96], help="grid sizes (voxels per axis)")
+parser.add_argument("-v", "--voxelsizes", nargs='+', default=['1,1,1', '0.5,0.5,2'], help="voxel sizes in mm, as x,y,z")
+parser.add_argument("-p", "--pairs", nargs='+', default=['sphere-sphere', 'sphere-tube', 'sphere-tract', 'tract-tract'],
+                    help="mask pairs to generate (sphere, tube, tract)")
+parser.add_argument("-m", "--modes", nargs='+', default=eds.modes, help="distance modes to time")
+parser.add_argument("-b", "--brute_max", type=float, default=2e6,
+                    help="largest number of voxel pairs for the brute force reference, the blocked engine is used above")
+parser.add_argument("-r", "--repeats", type=int, default=1, help="repeats per engine, the fastest run is reported")
+parser.add_argument("-o", "--output", help="csv file for the results")
+args = parser.parse_args()
+
+
+# synthetic masks on a grid of size n, coordinates as fractions of the field of view
+def sphere(n, centre, radius):
+    g = np.indices((n, n, n)) / n
+    return np.sum([(g[i] - centre[i]) ** 2 for i in range(3)], axis=0) <= radius ** 2
+
+def tube(n, centre, radius):
+    # straight tube along the z axis
+    g = np.indices((n, n)) / n
+    disk = (g[0] - centre[0]) ** 2 + (g[1] - centre[1]) ** 2 <= radius ** 2
+    return np.repeat(disk[:, :, None], n, axis=2)
+
+def tract(n, centre, radius):
+    # curved tube along z with a varying radius, roughly like a tract map
+    mask = np.zeros((n, n, n), bool)
+    g = np.indices((n, n)) / n
+    for k in range(n):
+        z = k / n
+        cx = centre[0] + 0.15 * np.sin(2 * np.pi * z)
+        cy = centre[1] + 0.1 * np.cos(3 * np.pi * z)
+        r = radius * (0.6 + 0.4 * np.sin(np.pi * z))
+        mask[:, :, k] = (g[0] - cx) ** 2 + (g[1] - cy) ** 2 <= r ** 2
+    return mask
+
+shapes = {'sphere': lambda n: sphere(n, (0.3, 0.5, 0.5), 0.1),
+          'tube': lambda n: tube(n, (0.6, 0.5), 0.08),
+          'tract': lambda n: tract(n, (0.65, 0.45), 0.1)}
+# the second masks, moved so a mask is never compared with itself
+shapes_b = dict(shapes, sphere=lambda n: sphere(n, (0.7, 0.5, 0.5), 0.15),
+                tract=lambda n: tract(n, (0.3, 0.55), 0.08))
+
+
+# run fn repeats times, return the last result, the fastest time and the largest peak memory
+def measure(fn, repeats):
+    best = np.inf
+    peak = 0
+    for r in range(repeats):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return out, best, peak
+
+def pairSet(A, B, alidx):
+    return set(zip(map(tuple, A['ijk'][alidx[0]]), map(tuple, B['ijk'][alidx[1]])))
+
+
+rows = []
+failed = False
+tmp_dir = tempfile.mkdtemp(prefix='KUL_EDs_bench_')
+print('case, mode, voxels_A, voxels_B, prepare_s, engine_s, peak_MB, min_dist, n_pairs, reference, agrees')
+for pair in args.pairs:
+    name_a, name_b = pair.split('-')
+    for vs in args.voxelsizes:
+        vox = [float(v) for v in vs.split(',')]
+        for n in args.sizes:
+            case = pair + '_' + str(n) + '_' + vs.replace(',', 'x')
+            aff = np.diag(vox + [1])
+            files = []
+            for label, mask in (('A', shapes[name_a](n)), ('B', shapes_b[name_b](n))):
+                f = os.path.join(tmp_dir, 'sub-bench_' + case + '_' + label + '.nii')
+                nib.save(nib.Nifti1Image(np.uint8(mask), aff), f)
+                files.append(f)
+
+            (A, B), t_prep, _ = measure(lambda: (eds.prepareMask(files[0]), eds.prepareMask(files[1])), 1)
+            n_pairs = A['xyz'].shape[0] * B['xyz'].shape[0]
+            ref_mode = 'brute' if n_pairs <= args.brute_max else 'blocked'
+
+            ref = None
+            for mode in [ref_mode] + [m for m in args.modes if m != ref_mode]:
+                if mode == 'brute' and n_pairs > args.brute_max:
+                    continue
+                (all_min, alidx, dist_map, used, _), t_eng, peak = measure(lambda: eds.minDist(A, B, mode), args.repeats)
+                pairs = pairSet(A, B, alidx)
+                if ref is None:
+                    ref = (all_min, pairs)
+                agrees = bool(all_min == ref[0] and pairs == ref[1])
+                failed = failed or not agrees
+                row = {'case': case, 'mode': mode, 'voxels_A': A['xyz'].shape[0], 'voxels_B': B['xyz'].shape[0],
+                       'prepare_s': round(t_prep, 4), 'engine_s': round(t_eng, 4), 'peak_MB': round(peak / 2 ** 20, 2),
+                       'min_dist': float(all_min), 'n_pairs': len(pairs), 'reference': ref_mode, 'agrees': agrees}
+                print(', '.join(str(v) for v in row.values()))
+                rows.append(row)
+            for f in files:
+                os.remove(f)
+os.rmdir(tmp_dir)
+
+if args.output:
+    with open(args.output, 'w', newline='') as file_handler:
+        writer = csv.DictWriter(file_handler, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print('Results written to', args.output)
+
+if failed:
+    print('Some engines do not agree with the reference')
+    sys.exit(1)
+sys.exit(0)
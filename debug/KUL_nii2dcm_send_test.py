@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Check of the --send mode of KUL_nii2dcm.py against a local DICOM storage SCP
+# no PACS needed: an in-process pynetdicom storage SCP stands in for the DICOM node
+#
+# synthetic niftis and a donor dicom are generated, then KUL_nii2dcm.py sends
+#  - a single-frame series (one object per slice, one association)
+#  - a multi-frame series (-m, one enhanced MR object)
+#  - a batch manifest of several series (-b, the series sent in parallel, one association each)
+# and for every case it checks what the SCP received:
+#  - the number of objects and associations
+#  - the SOP class, unique SOP instance UIDs, and one series instance UID per series
+#
+# exits with 1 if any check fails, so it can be used as a regression check
+# needs SimpleITK, nibabel, pydicom and pynetdicom
+#
+# e.g.
+#   python3 debug/KUL_nii2dcm_send_test.py
+#   python3 debug/KUL_nii2dcm_send_test.py -s 32 32 24 -p 11113
+
+import os, sys, argparse, tempfile, shutil, subprocess, threading
+import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from pynetdicom import AE, evt, AllStoragePresentationContexts
+
+parser = argparse.ArgumentParser(description="Check the --send mode of KUL_nii2dcm.py against a local storage SCP",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("-s", "--size", nargs=3, type=int, default=[24, 20, 12], help="nifti size (x y z)")
+parser.add_argument("-p", "--port", type=int, default=11112, help="port of the local storage SCP")
+parser.add_argument("-n", "--nseries", type=int, default=3, help="number of series in the batch case")
+args = parser.parse_args()
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'KUL_nii2dcm.py')
+aet = 'STORESCP'
+mr_storage = '1.2.840.10008.5.1.4.1.1.4'
+enhanced_mr_storage = '1.2.840.10008.5.1.4.1.1.4.1'
+
+
+# the storage SCP keeps what it receives, per association
+received = []
+lock = threading.Lock()
+
+def handleStore(event):
+    ds = event.dataset
+    ds.file_meta = event.file_meta
+    with lock:
+        received.append((event.assoc.native_id, ds))
+    return 0x0000
+
+def startScp(port):
+    ae = AE(ae_title=aet)
+    ae.supported_contexts = AllStoragePresentationContexts
+    return ae.start_server(('localhost', port), block=False, evt_handlers=[(evt.EVT_C_STORE, handleStore)])
+
+
+# a donor dicom and niftis with a RAS affine, like most of our inputs
+def makeInputs(tmp_dir, size, n):
+    donor = sitk.GetImageFromArray(np.zeros((1, 8, 8), np.int16))
+    for k, v in [("0010|0010", "Send^Test"), ("0010|0020", "SEND01"), ("0008|0060", "MR"),
+                 ("0020|000d", "1.2.826.0.1.3680043.2.1125.1.1"), ("0008|0020", "20240101")]:
+        donor.SetMetaData(k, v)
+    donor_file = os.path.join(tmp_dir, 'donor.dcm')
+    sitk.WriteImage(donor, donor_file)
+    niftis = []
+    for i in range(n):
+        data = np.random.default_rng(i).random(size).astype(np.float32) * 1000
+        nii = os.path.join(tmp_dir, 'series' + str(i + 1) + '.nii.gz')
+        nib.save(nib.Nifti1Image(data, np.diag([1.0, 1.1, 2.0, 1])), nii)
+        niftis.append(nii)
+    return donor_file, niftis
+
+def runSend(options):
+    cmd = [sys.executable, script] + options + ['--send', 'localhost:' + str(args.port) + ':' + aet]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        print(result.stdout)
+    return result.returncode
+
+# compare what was received with what was expected, returns True if all is well
+def check(case, returncode, n_series, n_objects, sop_class):
+    with lock:
+        got = list(received)
+        received.clear()
+    datasets = [ds for assoc, ds in got]
+    series_uids = set(str(ds.SeriesInstanceUID) for ds in datasets)
+    sop_uids = set(str(ds.SOPInstanceUID) for ds in datasets)
+    associations = set(assoc for assoc, ds in got)
+    checks = {'exit code 0': returncode == 0,
+              'objects': len(datasets) == n_series * n_objects,
+              'associations': len(associations) == n_series,
+              'series UIDs': len(series_uids) == n_series,
+              'unique SOP instance UIDs': len(sop_uids) == len(datasets),
+              'SOP class': all(str(ds.SOPClassUID) == sop_class for ds in datasets),
+              'meta matches dataset': all(str(ds.file_meta.MediaStorageSOPInstanceUID) == str(ds.SOPInstanceUID)
+                                          for ds in datasets)}
+    wrong = [k for k, ok in checks.items() if not ok]
+    print(case + ', ' + str(len(datasets)) + ' objects, ' + str(len(associations)) + ' associations, ' +
+          ('wrong: ' + ', '.join(wrong) if wrong else 'ok'))
+    return all(checks.values())
+
+
+tmp_dir = tempfile.mkdtemp(prefix='KUL_nii2dcm_send_')
+server = startScp(args.port)
+failed = False
+try:
+    donor_file, niftis = makeInputs(tmp_dir, args.size, args.nseries)
+    depth = args.size[2]
+
+    rc = runSend(['-s', 'single', '-n', '1', niftis[0], donor_file])
+    failed |= not check('single-frame', rc, 1, depth, mr_storage)
+
+    rc = runSend(['-m', '-s', 'multi', '-n', '2', niftis[0], donor_file])
+    failed |= not check('multi-frame', rc, 1, 1, enhanced_mr_storage)
+
+    manifest = os.path.join(tmp_dir, 'manifest.csv')
+    with open(manifest, 'w') as file_handler:
+        file_handler.write('nifti,seriesdescription,seriesnumber\n')
+        for i, nii in enumerate(niftis):
+            file_handler.write(nii + ',batch ' + str(i + 1) + ',' + str(10 + i) + '\n')
+    rc = runSend(['-b', manifest, donor_file])
+    failed |= not check('batch single-frame', rc, args.nseries, depth, mr_storage)
+
+    rc = runSend(['-b', '-m', manifest, donor_file])
+    failed |= not check('batch multi-frame', rc, args.nseries, 1, enhanced_mr_storage)
+finally:
+    server.shutdown()
+    shutil.rmtree(tmp_dir)
+
+if failed:
+    print('Some sends were not received as expected')
+    sys.exit(1)
+sys.exit(0)